@@ -0,0 +1,151 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from urllib.request import urlopen
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ORG = 'bench-org'
+PROJECT = 'bench-org/repo-0'
+
+# the scripts to benchmark and their arguments, each run against the mock server
+SCRIPTS = {
+    'repos': ['circleci-repos.py', '-o', ORG],
+    'members': ['circleci-repos.py', '-o', ORG, '-m'],
+    'logs': ['circleci-logs.py', '-p', PROJECT],
+    'vulnerable-config': ['circleci-vulnerable-config.py', '-p', PROJECT],
+}
+
+MOCK_OPTIONS = ('repos', 'members', 'member_repos', 'prs', 'builds', 'steps', 'log_size', 'latency', 'rate_limit', 'retry_after', 'error_rate', 'seed')
+
+
+parser = ArgumentParser(description="Benchmarks the circleci-* scripts against bench/mock_server.py, reporting requests/sec, MB/sec, wall time and peak RSS.")
+parser.add_argument("-s", "--scripts", default=','.join(SCRIPTS), help="Comma separated scripts to run, from %s" % (', '.join(SCRIPTS)))
+parser.add_argument("-w", "--workers", type=int, default=10, help="Workers passed to each script")
+parser.add_argument("-r", "--repeat", type=int, default=1, help="Number of times to run each script, the best run is reported")
+parser.add_argument("--port", type=int, default=8765, help="Port to run the mock server on")
+parser.add_argument("--rate", type=float, default=0, help="--rate passed to each script, the mock serves both APIs and the logs from one host so this defaults to 0 for no limit")
+parser.add_argument("--cache", action="store_true", help="Use the HTTP response cache, shared by the runs, rather than disabling it")
+parser.add_argument("-o", "--output", help="JSONL file to append the results to, so they can be compared over time")
+parser.add_argument("--repos", type=int, default=50, help="Number of repos in the org")
+parser.add_argument("--members", type=int, default=5, help="Number of members in the org")
+parser.add_argument("--member-repos", type=int, default=4, help="Number of personal repos of every member")
+parser.add_argument("--prs", type=int, default=10, help="Number of PRs from forks in the project")
+parser.add_argument("--builds", type=int, default=100, help="Number of builds in the project")
+parser.add_argument("--steps", type=int, default=5, help="Number of steps, and so logs, in every build")
+parser.add_argument("--log-size", type=int, default=16 * 1024, help="Approximate size in bytes of every log")
+parser.add_argument("--latency", type=float, default=0.02, help="Seconds the mock server waits before every response")
+parser.add_argument("--rate-limit", type=float, default=0.0, help="Fraction of requests the mock server answers with a 429")
+parser.add_argument("--retry-after", type=int, default=0, help="Retry-After seconds sent with the 429s")
+parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests the mock server answers with a 500")
+parser.add_argument("--seed", type=int, default=0, help="Random seed for the injected 429s and failures")
+parser.add_argument("-v", "--verbose", action="store_true", help="Show the scripts' output")
+
+args = parser.parse_args()
+
+scripts = args.scripts.split(',')
+for name in scripts:
+    if name not in SCRIPTS:
+        print('Unknown script %s, must be one of %s' % (name, ', '.join(SCRIPTS)))
+        exit(1)
+
+base = 'http://127.0.0.1:%s' % (args.port)
+
+
+def server_stats():
+    with urlopen('%s/stats' % (base)) as res:
+        return json.loads(res.read())
+
+
+def start_server():
+    command = [sys.executable, os.path.join(REPO_DIR, 'bench', 'mock_server.py'), '--port', str(args.port)]
+    for option in MOCK_OPTIONS:
+        command += ['--%s' % (option.replace('_', '-')), str(getattr(args, option))]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    for i in range(50):
+        try:
+            server_stats()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    print('Mock server did not start on port %s' % (args.port))
+    exit(1)
+
+
+def run(name, work_dir, cache_dir):
+    """Runs a script in work_dir, returning its exit code, wall time, peak RSS in MB and what the mock server served."""
+    command = [sys.executable, os.path.join(REPO_DIR, SCRIPTS[name][0])] + SCRIPTS[name][1:] + [
+        '-w', str(args.workers), '--rate', str(args.rate), '--circleci-url', '%s/api/v1.1' % (base), '--github-url', '%s/github' % (base),
+        '--cache', os.path.join(cache_dir, 'http.sqlite') if args.cache else ''
+    ]
+    before = server_stats()
+    start = time.monotonic()
+    output = None if args.verbose else subprocess.DEVNULL
+    process = subprocess.Popen(command, cwd=work_dir, stdout=output, stderr=output)
+    # wait4 gives the resource usage of this child alone
+    pid, status, usage = os.wait4(process.pid, 0)
+    wall = time.monotonic() - start
+    after = server_stats()
+    served = dict((key, after[key] - before[key]) for key in after)
+    return {
+        'script': name,
+        'exit_code': os.waitstatus_to_exitcode(status),
+        'wall': round(wall, 3),
+        'requests': served['requests'],
+        'requests_per_sec': round(served['requests'] / wall, 1),
+        'mb': round(served['bytes'] / 1024 / 1024, 2),
+        'mb_per_sec': round(served['bytes'] / 1024 / 1024 / wall, 2),
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+        'rate_limited': served['rate_limited'],
+        'errors': served['errors'],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+server = start_server()
+cache_dir = tempfile.mkdtemp(prefix='circleci-bench-cache-')
+results = []
+try:
+    for name in scripts:
+        best = None
+        for i in range(args.repeat):
+            # every run starts from an empty out/ directory so the logs script downloads everything again
+            work_dir = tempfile.mkdtemp(prefix='circleci-bench-')
+            try:
+                result = run(name, work_dir, cache_dir)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            if best is None or result['wall'] < best['wall']:
+                best = result
+        results.append(best)
+finally:
+    server.terminate()
+    server.wait()
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+print('%-18s %5s %9s %9s %8s %8s %8s %12s' % ('script', 'exit', 'wall s', 'requests', 'req/s', 'MB', 'MB/s', 'peak RSS MB'))
+for result in results:
+    print('%-18s %5s %9.2f %9s %8.1f %8.2f %8.2f %12.1f' % (
+        result['script'], result['exit_code'], result['wall'], result['requests'], result['requests_per_sec'],
+        result['mb'], result['mb_per_sec'], result['peak_rss_mb']
+    ))
+
+if args.output:
+    run_info = {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'commit': git_commit(), 'workers': args.workers, 'rate': args.rate, 'cache': args.cache}
+    run_info.update(dict((option, getattr(args, option)) for option in MOCK_OPTIONS))
+    with open(args.output, 'a') as f:
+        for result in results:
+            f.write(json.dumps(dict(run_info, **result)) + '\n')
@@ -0,0 +1,201 @@
+import json
+import random
+import re
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+parser = ArgumentParser(description="Serves synthetic Github and CircleCI API responses for benchmarking the circleci-* scripts offline. "
+                                    "The CircleCI API is served under /api/v1.1, Github under /github and build logs under /output")
+parser.add_argument("-p", "--port", type=int, default=8765, help="Port to listen on")
+parser.add_argument("--repos", type=int, default=50, help="Number of repos in every org, every other one has a CircleCI project")
+parser.add_argument("--members", type=int, default=5, help="Number of members in every org")
+parser.add_argument("--member-repos", type=int, default=4, help="Number of personal repos of every member")
+parser.add_argument("--prs", type=int, default=10, help="Number of PRs from forks in every repo")
+parser.add_argument("--builds", type=int, default=100, help="Number of builds in every CircleCI project")
+parser.add_argument("--steps", type=int, default=5, help="Number of steps in every build, each with one action and log")
+parser.add_argument("--log-size", type=int, default=16 * 1024, help="Approximate size in bytes of every build log")
+parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before every response")
+parser.add_argument("--rate-limit", type=float, default=0.0, help="Fraction of requests to answer with a 429 and Retry-After")
+parser.add_argument("--retry-after", type=int, default=0, help="Retry-After seconds sent with the 429s")
+parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests to answer with a 500")
+parser.add_argument("--url-expiry", type=int, default=0, help="Seconds the signed log output_urls in build details are valid for, 0 for never expiring")
+parser.add_argument("--seed", type=int, default=0, help="Random seed for the injected 429s and failures")
+
+args = parser.parse_args()
+
+PER_PAGE = 30
+ENV_HEADER = 'Using environment variables from project settings and/or contexts:'
+
+stats_lock = threading.Lock()
+stats = {'requests': 0, 'bytes': 0, 'rate_limited': 0, 'errors': 0}
+rng = random.Random(args.seed)
+logs = {}
+
+
+def log_body(kind):
+    # bodies only depend on the kind of step, so each is built once
+    if kind not in logs:
+        if kind == 'env':
+            lines = [ENV_HEADER] + ['  SECRET_%s=**REDACTED**' % (i) for i in range(5)] + ['  CIRCLE_JOB=**REDACTED**', '']
+        else:
+            lines = []
+        line = 0
+        while sum(len(l) + 1 for l in lines) < args.log_size:
+            lines.append('%s line %s of the build output' % (kind, line))
+            line += 1
+        logs[kind] = json.dumps([{'message': '\n'.join(lines), 'type': 'out'}]).encode()
+    return logs[kind]
+
+
+def output_url(base, org, repo, build_num, job):
+    url = '%s/output/%s/%s/%s/%s' % (base, org, repo, build_num, job)
+    # like S3 presigned URLs, output_urls stop working once they expire
+    if args.url_expiry:
+        url += '?Expires=%s&Signature=mock' % (int(time.time()) + args.url_expiry)
+    return url
+
+
+def build_details(base, org, repo, build_num):
+    # PR n was built as build builds - n, so the newest builds are PR builds
+    pr = args.builds - build_num
+    is_pr = 1 <= pr <= args.prs
+    steps = [{'name': 'Spin up Environment', 'actions': [{'name': 'Preparing Environment Variables', 'output_url': output_url(base, org, repo, build_num, 0)}]}]
+    for j in range(1, args.steps):
+        steps.append({'name': 'Run step %s' % (j), 'actions': [{'name': 'Run step %s' % (j), 'output_url': output_url(base, org, repo, build_num, j)}]})
+    return {
+        'build_num': build_num,
+        'lifecycle': 'finished',
+        'status': 'success' if build_num % 5 else 'failed',
+        'branch': 'pull/%s' % (pr) if is_pr else 'master',
+        'user': {'is_user': True, 'login': 'contributor-%s' % (pr) if is_pr else 'maintainer'},
+        'start_time': '2020-01-01T00:%02d:00Z' % (build_num % 60),
+        'stop_time': '2020-01-01T00:%02d:30Z' % (build_num % 60),
+        'steps': steps
+    }
+
+
+def has_project(repo):
+    match = re.match(r'^repo-(\d+)$', repo)
+    return not match or int(match.group(1)) % 2 == 0
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *values):
+        pass
+
+    def send(self, status, body, headers=None, counted=True):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        if counted:
+            with stats_lock:
+                stats['bytes'] += len(body)
+
+    def send_page(self, items, path, query):
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query.get('per_page', [PER_PAGE])[0])
+        last = max((len(items) + per_page - 1) // per_page, 1)
+        headers = {'ETag': '"%s-%s-%s"' % (path, per_page, page)}
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            return self.send(304, b'', headers)
+        if page < last:
+            base = 'http://%s%s' % (self.headers['Host'], path)
+            headers['Link'] = '<%s?per_page=%s&page=%s>; rel="next", <%s?per_page=%s&page=%s>; rel="last"' % (base, per_page, page + 1, base, per_page, last)
+        return self.send(200, items[(page - 1) * per_page:page * per_page], headers)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with stats_lock:
+                current = dict(stats)
+            return self.send(200, current, counted=False)
+        with stats_lock:
+            stats['requests'] += 1
+            roll = rng.random()
+        if args.latency:
+            time.sleep(args.latency)
+        if roll < args.rate_limit:
+            with stats_lock:
+                stats['rate_limited'] += 1
+            return self.send(429, {'message': 'Rate limited'}, {'Retry-After': str(args.retry_after)})
+        if roll < args.rate_limit + args.error_rate:
+            with stats_lock:
+                stats['errors'] += 1
+            return self.send(500, {'message': 'Internal error'})
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        base = 'http://%s' % (self.headers['Host'])
+
+        match = re.match(r'^/github/orgs/([^/]+)/repos$', url.path)
+        if match:
+            return self.send_page([{'name': 'repo-%s' % (i)} for i in range(args.repos)], url.path, query)
+        match = re.match(r'^/github/orgs/([^/]+)/members$', url.path)
+        if match:
+            return self.send_page([{'login': 'member-%s' % (i)} for i in range(args.members)], url.path, query)
+        match = re.match(r'^/github/users/([^/]+)/repos$', url.path)
+        if match:
+            return self.send_page([{'name': '%s-repo-%s' % (match.group(1), i)} for i in range(args.member_repos)], url.path, query)
+        match = re.match(r'^/github/repos/([^/]+)/([^/]+)/pulls$', url.path)
+        if match:
+            prs = [{
+                'number': n,
+                'user': {'login': 'contributor-%s' % (n)},
+                'author_association': 'CONTRIBUTOR',
+                'created_at': '2020-01-01T00:00:00Z',
+                'merged_at': None,
+                'head': {'sha': 'sha-%s' % (n), 'repo': {'fork': True, 'full_name': 'contributor-%s/%s' % (n, match.group(2))}}
+            } for n in range(1, args.prs + 1)]
+            return self.send_page(prs, url.path, query)
+        match = re.match(r'^/github/repos/([^/]+)/([^/]+)/commits/sha-(\d+)/status$', url.path)
+        if match:
+            build_num = args.builds - int(match.group(3))
+            target = 'https://circleci.com/gh/%s/%s/%s' % (match.group(1), match.group(2), build_num)
+            return self.send(200, {'state': 'success', 'statuses': [{'state': 'success', 'created_at': '2020-01-01T00:05:00Z', 'target_url': target}]})
+
+        match = re.match(r'^/api/v1\.1/project/github/([^/]+)/([^/]+)(?:/(\d+))?$', url.path)
+        if match:
+            org, repo, build_num = match.groups()
+            if not has_project(repo):
+                return self.send(404, {'message': 'Project not found'})
+            if build_num:
+                if not 1 <= int(build_num) <= args.builds:
+                    return self.send(404, {'message': 'Build not found'})
+                return self.send(200, build_details(base, org, repo, int(build_num)))
+            limit = int(query.get('limit', ['30'])[0])
+            offset = int(query.get('offset', ['0'])[0])
+            builds = [build_details(base, org, repo, b) for b in range(args.builds - offset, max(args.builds - offset - limit, 0), -1)]
+            for build in builds:
+                del build['steps']
+            return self.send(200, builds)
+        match = re.match(r'^/output/([^/]+)/([^/]+)/(\d+)/(\d+)$', url.path)
+        if match:
+            if 'Expires' in query and int(query['Expires'][0]) < time.time():
+                return self.send(403, b'<Error><Code>AccessDenied</Code><Message>Request has expired</Message></Error>')
+            return self.send(200, log_body('env' if match.group(4) == '0' else 'step'))
+        return self.send(404, {'message': 'Not found'})
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients closing kept alive connections as they exit isn't an error
+        pass
+
+
+if __name__ == '__main__':
+    server = Server(('127.0.0.1', args.port), Handler)
+    print('Serving on http://127.0.0.1:%s' % (args.port), flush=True)
+    server.serve_forever()
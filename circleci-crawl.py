@@ -0,0 +1,194 @@
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+import circleci_queue
+
+
+LOGS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'circleci-logs.py')
+OUT_DIR = 'out/circleci'
+# seconds between checks for new work when the queue is empty but other workers still hold leases
+POLL_SECONDS = 5
+
+print_lock = threading.Lock()
+
+
+def say(message):
+    with print_lock:
+        print(message, flush=True)
+
+
+def add(args):
+    projects = list(args.projects)
+    if args.projects_file:
+        projects_file = sys.stdin if args.projects_file == '-' else open(args.projects_file)
+        projects += [line.strip() for line in projects_file if line.strip() and not line.startswith('#')]
+    for project in projects:
+        if '/' not in project:
+            print('Project must be in the format org/repo: %s' % (project))
+            exit(1)
+    queue = circleci_queue.Queue(args.queue)
+    queue.add_projects(projects)
+    print('Queued %s projects to list in %s' % (len(projects), args.queue))
+
+
+def synced_builds(project, build_nums):
+    """Returns which of build_nums the project's manifest has recorded, however the download went."""
+    manifest = os.path.join(OUT_DIR, project, 'manifest.sqlite')
+    if not os.path.exists(manifest):
+        return set()
+    db = sqlite3.connect(manifest, timeout=60)
+    try:
+        rows = db.execute('SELECT build_num FROM builds WHERE build_num IN (%s)' % (','.join('?' * len(build_nums))), build_nums)
+        return set(row[0] for row in rows)
+    finally:
+        db.close()
+
+
+def run_logs(queue, lease, options, verbose):
+    """Runs circleci-logs.py for a lease, heartbeating while it runs. Returns its exit code and last line of output, or None if the lease was lost."""
+    command = [sys.executable, LOGS_SCRIPT, '-p', lease.project] + options
+    with tempfile.TemporaryFile() as output:
+        process = subprocess.Popen(command, stdout=None if verbose else output, stderr=subprocess.STDOUT)
+        while True:
+            try:
+                code = process.wait(timeout=queue.lease_seconds / 3)
+                break
+            except subprocess.TimeoutExpired:
+                if not queue.heartbeat(lease):
+                    # the items may already be with another worker, which would be racing this one
+                    process.kill()
+                    process.wait()
+                    return None, None
+        output.seek(0)
+        lines = output.read().decode(errors='replace').strip().splitlines()
+    return code, lines[-1] if lines else 'exited with code %s' % (code)
+
+
+def work_lease(queue, lease, args, options):
+    if lease.kind == circleci_queue.LIST:
+        with tempfile.TemporaryDirectory() as tmp:
+            listed = os.path.join(tmp, 'builds.json')
+            code, last = run_logs(queue, lease, options + ['--list-to', listed], args.verbose)
+            if code is None:
+                say('Lost the lease on listing %s' % (lease.project))
+                return 0, 0
+            if code != 0 or not os.path.exists(listed):
+                queue.finish(lease, failed=[0], error=last)
+                say('Failed to list %s: %s' % (lease.project, last))
+                return 0, 1
+            with open(listed) as f:
+                builds = json.load(f)
+        queue.finish(lease, listed=builds)
+        say('Listed %s, queued %s builds' % (lease.project, len(builds)))
+        return 0, 0
+
+    build_options = []
+    for build_num in lease.builds:
+        build_options += ['--build', str(build_num)]
+    code, last = run_logs(queue, lease, options + build_options, args.verbose)
+    if code is None:
+        say('Lost the lease on %s builds of %s' % (len(lease.builds), lease.project))
+        return 0, 0
+    # the manifest is the record of which builds made it, whatever happened to the process
+    failed = sorted(set(lease.builds) - synced_builds(lease.project, lease.builds))
+    queue.finish(lease, failed=failed, error=last)
+    say('Downloaded %s of %s builds of %s (%s-%s)%s' % (
+        len(lease.builds) - len(failed), len(lease.builds), lease.project, lease.builds[0], lease.builds[-1],
+        ', %s failed: %s' % (len(failed), last) if failed else ''
+    ))
+    return len(lease.builds) - len(failed), len(failed)
+
+
+def worker(name, args, options, totals):
+    # sqlite connections can't be shared between threads, so every worker opens its own
+    queue = circleci_queue.Queue(args.queue, args.lease_seconds, args.max_attempts)
+    try:
+        while True:
+            lease = queue.lease(name, args.batch)
+            if lease is None:
+                # leases held by other workers can still expire, or list items queue more builds
+                if args.wait or queue.outstanding():
+                    time.sleep(POLL_SECONDS)
+                    continue
+                return
+            done, failed = work_lease(queue, lease, args, options)
+            with print_lock:
+                totals['builds'] += done
+                totals['failed'] += failed
+    finally:
+        queue.close()
+
+
+def work(args, options):
+    if args.leases < 1 or args.batch < 1:
+        print('Leases and batch must be at least 1')
+        exit(1)
+    # workers on other machines are told apart by host and pid
+    name = '%s:%s' % (socket.gethostname(), os.getpid())
+    totals = {'builds': 0, 'failed': 0}
+    start = time.monotonic()
+    threads = [threading.Thread(target=worker, args=('%s:%s' % (name, i), args, options, totals), daemon=True) for i in range(args.leases)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        print('Downloaded %s builds, %s failed attempts, in %.1fs' % (totals['builds'], totals['failed'], time.monotonic() - start))
+
+
+def status(args):
+    queue = circleci_queue.Queue(args.queue)
+    for kind, counts in sorted(queue.counts().items()):
+        print('%s: %s' % (kind, ', '.join('%s %s' % (counts.get(state, 0), state) for state in ('pending', 'leased', 'done', 'failed'))))
+    if args.failed:
+        for kind, project, build_num, attempts, error in queue.failures():
+            print('%s %s%s failed %s times: %s' % (kind, project, ' %s' % (build_num) if kind == circleci_queue.BUILD else '', attempts, error))
+
+
+def retry(args):
+    queue = circleci_queue.Queue(args.queue)
+    print('Queued %s failed items again' % (queue.retry_failed()))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Splits downloading the logs of many projects between workers, on one or more machines, through a shared queue of builds.")
+    parser.add_argument("-q", "--queue", default="out/crawl.sqlite", help="SQLite queue shared by the workers, on storage every worker can reach along with out/circleci")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = subparsers.add_parser("add", help="Queue projects to be listed, and then their builds downloaded")
+    add_parser.add_argument("projects", nargs="*", help="Projects in the format of org/repo")
+    add_parser.add_argument("-f", "--projects-file", help="File of org/repo projects, one per line, or - for stdin, e.g. the output of circleci-repos.py")
+    add_parser.set_defaults(func=add)
+
+    work_parser = subparsers.add_parser("work", help="Lease and download builds until the queue is empty, any other options are passed on to circleci-logs.py, e.g. -w, -z, --storage or --branch")
+    work_parser.add_argument("-l", "--leases", type=int, default=4, help="Number of leases to work on at once, each in its own circleci-logs.py process")
+    work_parser.add_argument("-b", "--batch", type=int, default=20, help="Number of builds of a project to lease at once")
+    work_parser.add_argument("--lease-seconds", type=int, default=300, help="Seconds a lease lasts without a heartbeat before its builds go to another worker")
+    work_parser.add_argument("--max-attempts", type=int, default=3, help="Number of times an item is tried before it is left as failed")
+    work_parser.add_argument("--wait", action="store_true", help="Keep waiting for more work once the queue is empty")
+    work_parser.add_argument("-v", "--verbose", action="store_true", help="Show the output of circleci-logs.py")
+    work_parser.set_defaults(func=work)
+
+    status_parser = subparsers.add_parser("status", help="Show how many items are pending, leased, done and failed")
+    status_parser.add_argument("-f", "--failed", action="store_true", help="List the failed items and their last error")
+    status_parser.set_defaults(func=status)
+
+    retry_parser = subparsers.add_parser("retry", help="Queue the failed items again")
+    retry_parser.set_defaults(func=retry)
+
+    args, options = parser.parse_known_args()
+    if args.command == 'work':
+        args.func(args, options)
+    elif options:
+        parser.error('unrecognized arguments: %s' % (' '.join(options)))
+    else:
+        args.func(args)
@@ -0,0 +1,305 @@
+import json
+import os
+import re
+import sqlite3
+import sys
+from array import array
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import circleci_store
+
+
+# regex syntax that ends a run of literal characters, quantifiers are handled separately
+REGEX_SPECIAL = '.^$[](){}|\\'
+REGEX_ESCAPES = 'dDwWsSbBAZ0123456789'
+QUANTIFIER = re.compile(r'\{\d*(?:,\d*)?\}')
+# escapes that go on past their letter, like \x41, \N{...}, octal and backreferences, are skipped whole
+LONG_ESCAPE = re.compile(r'x[0-9a-fA-F]{0,2}|u[0-9a-fA-F]{0,4}|U[0-9a-fA-F]{0,8}|N\{[^}]*\}|[0-7]{3}|0[0-7]{0,2}|\d{1,2}')
+# verbose mode ignores whitespace and comments, so its literals can't be read off the pattern
+VERBOSE_FLAG = re.compile(r'\(\?[aiLmsux]*x')
+
+
+# logs are read in chunks of this size so a huge log never has to be in memory whole
+CHUNK_SIZE = 8 * 1024 * 1024
+# an array typecode of exactly 4 bytes, which C doesn't fix for either
+WORD = 'I' if array('I').itemsize == 4 else 'L'
+
+
+def trigrams(data):
+    """Returns the trigrams of data as 24 bit ints."""
+    # the index is case insensitive, queries lower case their literals the same way
+    data = data.lower()
+    # reading data as big endian 4 byte words from offsets 0 and 2 gives every trigram as the top or bottom 3 bytes
+    # of a word, and lets set() collect the distinct words in C rather than a Python loop per byte
+    words = set()
+    for offset in (0, 2):
+        view = array(WORD, data[offset:offset + (len(data) - offset) // 4 * 4])
+        if sys.byteorder == 'little':
+            view.byteswap()
+        words.update(view)
+    grams = set(word >> 8 for word in words)
+    grams.update(word & 0xFFFFFF for word in words)
+    # the last few trigrams can fall after the last whole word
+    grams.update(int.from_bytes(data[i:i + 3], 'big') for i in range(max(len(data) - 10, 0), len(data) - 2))
+    return grams
+
+
+def index_log(log):
+    grams = set()
+    tail = b''
+    with log.open() as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            # chunks overlap by 2 bytes so trigrams across the boundary are kept
+            data = tail + chunk
+            grams.update(trigrams(data))
+            tail = data[-2:]
+    return log, grams
+
+
+def regex_literals(pattern):
+    """Returns literal strings every match of pattern must contain, or [] if none can be worked out.
+
+    Only top level literals are used, anything inside groups or classes is skipped, and a top level
+    alternation means nothing is required.
+    """
+    if VERBOSE_FLAG.search(pattern):
+        return []
+    literals = []
+    run = ''
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        literal = None
+        if c == '\\' and i + 1 < len(pattern):
+            i += 1
+            escape = LONG_ESCAPE.match(pattern, i)
+            if escape:
+                i = escape.end() - 1
+            elif depth == 0 and pattern[i] not in REGEX_ESCAPES and not pattern[i].isalpha():
+                literal = pattern[i]
+        elif c == '[':
+            # skip the whole class, a ] straight after [ or [^ is part of it
+            i += 2 if pattern[i + 1:i + 2] == '^' else 1
+            i += 1 if pattern[i:i + 1] == ']' else 0
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+        elif c == '{':
+            # skip a {m,n} quantifier's bounds, a { that doesn't start one is a literal but is left out of runs
+            quantifier = QUANTIFIER.match(pattern, i)
+            if quantifier:
+                i = quantifier.end() - 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return []
+        elif depth == 0 and c not in REGEX_SPECIAL and c not in '*+?':
+            literal = c
+        quantifier = pattern[i + 1:i + 2]
+        if literal is not None and quantifier not in ('*', '?', '{'):
+            run += literal
+        # anything else ends the run, as does a quantifier, though a literal repeated with + still appears once
+        if literal is None or quantifier in ('*', '?', '{', '+'):
+            if len(run) >= 3:
+                literals.append(run)
+            run = ''
+        i += 1
+    if len(run) >= 3:
+        literals.append(run)
+    return literals
+
+
+class Index:
+    """Trigram inverted index over downloaded logs, stored in SQLite.
+
+    Postings are kept per distinct content rather than per log, so identical logs, found by the sha256 the manifest
+    has for them, share one posting list. Logs without a digest get a content of their own.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS contents (id INTEGER PRIMARY KEY, digest TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, path TEXT NOT NULL, offset INTEGER NOT NULL,
+                length INTEGER NOT NULL, compressed INTEGER NOT NULL, stamp TEXT NOT NULL, content INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS docs_content ON docs (content);
+            CREATE TABLE IF NOT EXISTS postings (trigram INTEGER NOT NULL, content INTEGER NOT NULL, PRIMARY KEY (trigram, content)) WITHOUT ROWID;
+        """)
+
+    def stale(self, logs):
+        """Returns the logs which are new or changed since they were indexed, dropping any that were removed."""
+        known = dict((row[0], (row[1], row[2])) for row in self.db.execute('SELECT key, id, stamp FROM docs'))
+        changed = []
+        for log in logs:
+            doc = known.pop(log.key, None)
+            if doc is None or doc[1] != log.stamp:
+                changed.append(log)
+        for key, doc in known.items():
+            self.remove(doc[0])
+        self.db.commit()
+        return changed
+
+    def collect(self, content):
+        # a content's postings go once no log has it
+        if not self.db.execute('SELECT 1 FROM docs WHERE content = ? LIMIT 1', (content,)).fetchone():
+            self.db.execute('DELETE FROM postings WHERE content = ?', (content,))
+            self.db.execute('DELETE FROM contents WHERE id = ?', (content,))
+
+    def remove(self, doc):
+        row = self.db.execute('SELECT content FROM docs WHERE id = ?', (doc,)).fetchone()
+        self.db.execute('DELETE FROM docs WHERE id = ?', (doc,))
+        if row:
+            self.collect(row[0])
+
+    def indexed(self, digest):
+        """Returns the content already indexed for digest, or None."""
+        if digest is None:
+            return None
+        row = self.db.execute('SELECT id FROM contents WHERE digest = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def add_content(self, digest, grams):
+        content = self.db.execute('INSERT INTO contents (digest) VALUES (?)', (digest,)).lastrowid
+        self.db.executemany('INSERT INTO postings (trigram, content) VALUES (?, ?)', ((gram, content) for gram in grams))
+        return content
+
+    def add(self, log, content):
+        row = self.db.execute('SELECT id, content FROM docs WHERE key = ?', (log.key,)).fetchone()
+        if row:
+            self.db.execute('DELETE FROM docs WHERE id = ?', (row[0],))
+        self.db.execute(
+            'INSERT INTO docs (key, path, offset, length, compressed, stamp, content) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (log.key, log.path, log.offset, log.length, log.compressed, log.stamp, content)
+        )
+        # only once the new doc is in, as a log whose stamp changed can still have the same content
+        if row and row[1] != content:
+            self.collect(row[1])
+
+    def log(self, row):
+        org, repo, build, job = row[0].split('/')
+        return circleci_store.Log(org, repo, int(build), job, row[1], row[2], row[3], bool(row[4]))
+
+    def candidates(self, literals):
+        """Returns the logs containing every trigram of every literal, or all logs if there are none."""
+        grams = set()
+        for literal in literals:
+            grams |= trigrams(literal.encode())
+        if not grams:
+            return [self.log(row) for row in self.db.execute('SELECT key, path, offset, length, compressed FROM docs')]
+        contents = None
+        # intersect the rarest posting lists first so the candidate set shrinks as fast as possible
+        counts = sorted((self.db.execute('SELECT COUNT(*) FROM postings WHERE trigram = ?', (gram,)).fetchone()[0], gram) for gram in grams)
+        for count, gram in counts:
+            posting = set(row[0] for row in self.db.execute('SELECT content FROM postings WHERE trigram = ?', (gram,)))
+            contents = posting if contents is None else contents & posting
+            if not contents:
+                return []
+        contents = list(contents)
+        logs = []
+        # look the logs up in batches to stay under SQLite's bound parameter limit
+        for i in range(0, len(contents), 500):
+            batch = contents[i:i + 500]
+            placeholders = ','.join('?' * len(batch))
+            sql = 'SELECT key, path, offset, length, compressed FROM docs WHERE content IN (%s)' % (placeholders)
+            logs += [self.log(row) for row in self.db.execute(sql, batch)]
+        return logs
+
+
+def build(args):
+    if not os.path.isdir(args.directory):
+        print('Could not find downloaded logs in %s' % (args.directory))
+        exit(1)
+    index = Index(args.index)
+    stale = index.stale(circleci_store.iter_logs(args.directory))
+    # logs whose content is already indexed, under another key or an earlier stamp, only need pointing at it
+    unread = []
+    for log in stale:
+        content = index.indexed(log.digest)
+        if content is None:
+            unread.append(log)
+        else:
+            index.add(log, content)
+    # identical logs are only read once, and share the posting list of their content
+    unique, copies = circleci_store.unique_logs(unread)
+    if args.verbose:
+        print('Indexing %s new or changed logs, %s unique and not yet indexed...' % (len(stale), len(unique)))
+    indexed = len(stale) - len(unread)
+    with Pool(args.workers) as pool:
+        for log, grams in pool.imap_unordered(index_log, unique, chunksize=16):
+            content = index.add_content(log.digest, grams)
+            for copy in copies.get(log.digest, [log]):
+                index.add(copy, content)
+                indexed += 1
+                # commit in batches so an interrupted run keeps most of its work
+                if indexed % 1000 == 0:
+                    index.db.commit()
+                    if args.verbose:
+                        print('Indexed %s logs...' % (indexed))
+    index.db.commit()
+    if args.verbose:
+        print('Indexed %s logs' % (indexed))
+
+
+def query(args):
+    if not os.path.exists(args.index):
+        print('Could not find an index at %s, run the build command first' % (args.index))
+        exit(1)
+    index = Index(args.index)
+    if args.regex:
+        literals = regex_literals(args.pattern)
+        matcher = re.compile(args.pattern.encode(), re.IGNORECASE if args.ignore_case else 0)
+    else:
+        literals = [args.pattern]
+        matcher = re.compile(re.escape(args.pattern.encode()), re.IGNORECASE if args.ignore_case else 0)
+    if args.verbose and not any(len(literal) >= 3 for literal in literals):
+        print('Pattern has no literal of 3 or more characters, every log has to be searched', file=sys.stderr)
+    prefix = args.project.rstrip('/') + '/' if args.project else ''
+    matches = 0
+    for log in sorted(index.candidates(literals), key=lambda log: (log.org, log.repo, log.build, log.job)):
+        if not log.key.startswith(prefix) or not os.path.exists(log.path):
+            continue
+        for line_num, line in enumerate(log.read().split(b'\n'), 1):
+            if matcher.search(line):
+                result = {'org': log.org, 'repo': log.repo, 'build': log.build, 'job': log.job}
+                result.update({'line': line_num, 'text': line.decode(errors='replace')})
+                if args.json:
+                    print(json.dumps(result))
+                else:
+                    print('%s/%s/%s/%s:%s: %s' % (result['org'], result['repo'], result['build'], result['job'], line_num, result['text']))
+                matches += 1
+                if args.limit and matches >= args.limit:
+                    return
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Builds and queries an inverted index over logs downloaded by circleci-logs.py.")
+    parser.add_argument("-d", "--directory", default="out/circleci", help="Directory circleci-logs.py wrote logs to")
+    parser.add_argument("-x", "--index", default=None, help="Index file, defaults to index.sqlite in the logs directory")
+    parser.add_argument("-v", "--verbose", action="store_true", help="More output")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Index new and changed logs, removing logs that no longer exist")
+    build_parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Number of processes to read logs with")
+    build_parser.set_defaults(func=build)
+
+    query_parser = subparsers.add_parser("query", help="Search the indexed logs for a substring or regex")
+    query_parser.add_argument("pattern", help="Substring to search for, or a regex with --regex")
+    query_parser.add_argument("-r", "--regex", action="store_true", help="Treat the pattern as a regex")
+    query_parser.add_argument("-i", "--ignore-case", action="store_true", help="Case insensitive search")
+    query_parser.add_argument("-p", "--project", help="Only search this project, in the format of org/repo")
+    query_parser.add_argument("-j", "--json", action="store_true", help="Output matches as JSONL")
+    query_parser.add_argument("-l", "--limit", type=int, default=0, help="Stop after this many matching lines")
+    query_parser.set_defaults(func=query)
+
+    args = parser.parse_args()
+    if not args.index:
+        args.index = os.path.join(args.directory, 'index.sqlite')
+    args.func(args)
@@ -1,14 +1,43 @@
 import requests
 import json
 import os
+import re
+import sqlite3
+import threading
+import time
 from argparse import ArgumentParser
+from collections import Counter
+from fnmatch import fnmatch
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import circleci_http
+import circleci_metrics
+import circleci_store
+from circleci_metrics import metrics
 
 
 parser = ArgumentParser(description="Downloads build logs from circleci for a particular project and repo.")
 parser.add_argument("-p", "--project", help="project and repo to request circleci build logs for, in the format of project/repo")
 parser.add_argument("-t", "--token", default=None, help="API token for non public readable builds")
+parser.add_argument("-w", "--workers", type=int, default=1, help="Number of builds and logs to download concurrently")
+parser.add_argument("-z", "--gzip", action="store_true", help="Compress the downloaded logs with gzip, written as job-X-Y.gz")
+parser.add_argument("-s", "--storage", choices=['files', 'pack', 'objects'], default='files', help="Write each log to its own file, pack them into archives of --pack-builds builds with an index for reading single logs back, or store each distinct log once by its sha256 under out/circleci/.objects")
+parser.add_argument("--pack-builds", type=int, default=1, help="Number of consecutive builds per pack with --storage pack")
+parser.add_argument("--since", default=None, help="Oldest build to download, as a build number or an ISO 8601 date compared against the build stop_time")
+parser.add_argument("--until", default=None, help="Newest build to download, as a build number or an ISO 8601 date compared against the build stop_time")
+parser.add_argument("--step", default=None, help="Only download logs of steps whose step or action name matches this regex")
+parser.add_argument("--branch", action="append", help="Only download builds of branches matching this glob, e.g. 'pull/*', can be given more than once")
+parser.add_argument("--status", action="append", help="Only download builds with this status, e.g. success or failed, can be given more than once")
+parser.add_argument("--per-branch", type=int, default=0, help="Only download the newest N builds of each branch found in this run's listing")
+parser.add_argument("--max-size", type=int, default=0, help="Skip logs whose Content-Length is over this many bytes, checked before the body is read")
+parser.add_argument("--build", type=int, action="append", help="Only download this build, skipping the listing and so the listing filters, can be given more than once. Used by circleci-crawl.py workers")
+parser.add_argument("--list-to", default=None, help="List the builds that need downloading to this file as JSON, without downloading them. Used by circleci-crawl.py workers")
+circleci_http.add_arguments(parser)
+circleci_metrics.add_arguments(parser)
 
 args = parser.parse_args()
+circleci_metrics.start(args)
 
 if not args.project:
     print('Must supply a project value')
@@ -18,55 +47,405 @@ if '/' not in args.project:
     print('Project must be in the format project/repo')
     exit(1)
 
+if args.workers < 1:
+    print('Workers must be at least 1')
+    exit(1)
+
+if args.pack_builds < 1:
+    print('Pack builds must be at least 1')
+    exit(1)
+
+if args.build and args.list_to:
+    print('Only one of --build and --list-to can be given')
+    exit(1)
+
+
+def parse_bound(value):
+    # bounds are either a build number or a date
+    if value is None or value.isdigit():
+        return int(value) if value else None
+    try:
+        bound = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        print('Could not parse {} as a build number or date'.format(value))
+        exit(1)
+    return bound if bound.tzinfo else bound.replace(tzinfo=timezone.utc)
+
+
+since = parse_bound(args.since)
+until = parse_bound(args.until)
+
+try:
+    step_filter = re.compile(args.step) if args.step else None
+except re.error as e:
+    print('Could not parse {} as a regex: {}'.format(args.step, e))
+    exit(1)
+
 project = args.project.split('/')[0]
 repo = args.project.split('/')[1]
 token = args.token
+workers = args.workers
+compress = args.gzip
 outfiles = 'out/circleci/{}/{}'.format(project, repo)
 
 if not repo:
     print('Could not determine repo value')
     exit(1)
 
-url = 'https://circleci.com/api/v1.1/project/github/{}/{}'.format(project, repo)
+url = '{}/project/github/{}/{}'.format(args.circleci_url, project, repo)
 
 params = {}
 if token:
     params['circle-token'] = token
 
-s_circle = requests.session()
-r = s_circle.get(url, params=params)
 
-if not r.status_code == 200:
-    print('API request failed with code: {}'.format(r.status_code))
-    exit(1)
+# size the connection pools to the worker count so concurrent requests reuse connections
+s_circle = circleci_http.session(args, workers)
+s_s3 = circleci_http.session(args, workers)
 
 try:
     os.makedirs(outfiles)
 except FileExistsError as e:
     pass
 
-builds = r.json()
-
-latest = builds[0]['build_num']
-i = latest
-s_s3 = requests.session()
-while i > 0:
-    if os.path.exists('{}/{}'.format(outfiles, i)):
-        print('Skipping build {} ...'.format(i))
-    else:
-        os.mkdir('{}/{}'.format(outfiles, i))
-        print('Checking {}/{} ...'.format(url, i))
-        r_2 = s_circle.get('{}/{}'.format(url, i), params=params)
-        build_details = r_2.json()
-        if 'steps' in build_details:
-            for job, step in enumerate(build_details['steps']):
-                if 'actions' in step and len(step['actions']) > 0:
-                    for a, action in enumerate(step['actions']):
-                        if 'output_url' in action:
-                            print('Downloading {} ...'.format(action['output_url']))
-                            dl = s_s3.get(action['output_url'])
-                            filename = '{}/{}/job-{}-{}'.format(outfiles, i, job, a)
-                            content = dl.content.decode().replace('\\n', "\n")
-                            content = content.replace('\\r', "\r")
-                            open(filename, 'w').write(content)
-    i -= 1
+if args.storage == 'pack':
+    store = circleci_store.PackStore(outfiles, compress, args.pack_builds)
+elif args.storage == 'objects':
+    store = circleci_store.ObjectStore('out/circleci', outfiles, compress)
+else:
+    store = circleci_store.FileStore(outfiles, compress)
+
+
+class Manifest:
+    """Records completed builds and actions for a project so reruns only fetch new or incomplete builds."""
+
+    def __init__(self, path):
+        # crawl workers can write to the same project's manifest at once, so wait on each other's writes
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS builds (build_num INTEGER PRIMARY KEY, state TEXT NOT NULL, synced_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS actions (
+                build_num INTEGER NOT NULL, job INTEGER NOT NULL, action INTEGER NOT NULL,
+                path TEXT, size INTEGER, sha256 TEXT, PRIMARY KEY (build_num, job, action)
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        """)
+
+    def synced_builds(self):
+        # builds that were downloaded with some logs filtered out are revisited by later runs
+        return set(row[0] for row in self.db.execute("SELECT build_num FROM builds WHERE state != 'filtered'"))
+
+    def filtered_actions(self):
+        """Returns the actions already recorded for each filtered build, so later runs only fetch the rest."""
+        done = {}
+        sql = "SELECT build_num, job, action FROM actions JOIN builds USING (build_num) WHERE state = 'filtered'"
+        for build_num, job, action in self.db.execute(sql):
+            done.setdefault(build_num, set()).add((job, action))
+        return done
+
+    def synced_through(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'synced_through'").fetchone()
+        return row[0] if row else 0
+
+    def record_build(self, build_num, state, actions):
+        # the build row is only written once every action is on disk, in the same transaction, actions recorded by earlier filtered runs are kept
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO actions (build_num, job, action, path, size, sha256) VALUES (?, ?, ?, ?, ?, ?)',
+                [(build_num,) + action for action in actions]
+            )
+            self.db.execute('INSERT OR REPLACE INTO builds (build_num, state, synced_at) VALUES (?, ?, ?)', (build_num, state, time.time()))
+
+    def record_missing(self, build_nums):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO builds (build_num, state, synced_at) VALUES (?, 'missing', ?)",
+                [(build_num, time.time()) for build_num in build_nums]
+            )
+
+    def advance(self, synced):
+        # the highest build_num with every build at or below it synced, so later runs can stop there
+        with self.db:
+            # other processes may have synced builds since this one started, and moved synced_through on
+            self.db.execute('BEGIN IMMEDIATE')
+            synced = synced | self.synced_builds()
+            through = self.synced_through()
+            while through + 1 in synced:
+                through += 1
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('synced_through', ?)", (through,))
+        return through
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class IncompleteBuild(Exception):
+    pass
+
+
+class OutputUrlExpired(Exception):
+    pass
+
+
+# what the filters saved, counted across the worker threads
+avoided = Counter()
+avoided_lock = threading.Lock()
+
+
+# set on Ctrl-C, so builds and logs already running stop before their next request
+stopping = threading.Event()
+
+
+def avoid(kind, amount=1):
+    with avoided_lock:
+        avoided[kind] += amount
+
+
+def unescape_chunks(chunks):
+    # an escape split across a chunk boundary leaves a trailing backslash, so hold it back for the next chunk
+    carry = b''
+    busy = 0
+    for chunk in chunks:
+        start = time.perf_counter()
+        chunk = carry + chunk
+        carry = b''
+        if chunk.endswith(b'\\'):
+            chunk, carry = chunk[:-1], chunk[-1:]
+        chunk = chunk.replace(b'\\n', b"\n").replace(b'\\r', b"\r")
+        busy += time.perf_counter() - start
+        yield chunk
+    metrics.add('decode_seconds', busy)
+    if carry:
+        yield carry
+
+
+def download_action(output_url, i, job, a, cached=False):
+    if stopping.is_set():
+        raise IncompleteBuild('stopping')
+    with metrics.timed('log_seconds'):
+        print('Downloading {} ...'.format(output_url))
+        with s_s3.get(output_url, stream=True) as dl:
+            # output_urls are signed, so one from cached build details may just have expired
+            if dl.status_code == 403 and cached:
+                raise OutputUrlExpired()
+            # expired or removed logs will never come back, so they are recorded rather than retried
+            if dl.status_code in (403, 404):
+                return (job, a, None, None, None)
+            if dl.status_code != 200:
+                raise IncompleteBuild('log download failed with code: {}'.format(dl.status_code))
+            length = int(dl.headers.get('Content-Length') or 0)
+            if args.max_size and length > args.max_size:
+                # closing a streamed response before reading it leaves the body unread
+                print('Skipping {}, {} bytes is over --max-size ...'.format(output_url, length))
+                avoid('large_logs')
+                avoid('large_bytes', length)
+                return None
+            path, size, digest = store.write(i, 'job-{}-{}'.format(job, a), unescape_chunks(dl.iter_content(CHUNK_SIZE)))
+        return (job, a, path, size, digest)
+
+
+def wanted_step(step, action):
+    if not step_filter:
+        return True
+    return bool(step_filter.search(step.get('name') or '') or step_filter.search(action.get('name') or ''))
+
+
+def get_build_details(i, fresh=False):
+    """Returns a build's details and whether they came from the cache, or None if the build is gone."""
+    if stopping.is_set():
+        raise IncompleteBuild('stopping')
+    print('Checking {}/{} ...'.format(url, i))
+    headers = {'Cache-Control': 'no-cache'} if fresh else None
+    r_2 = s_circle.get('{}/{}'.format(url, i), params=params, headers=headers)
+    if r_2.status_code == 404:
+        return None, False
+    if r_2.status_code != 200:
+        raise IncompleteBuild('API request failed with code: {}'.format(r_2.status_code))
+    build_details = r_2.json()
+    if build_details.get('lifecycle') not in (None, 'finished', 'not_run'):
+        raise IncompleteBuild('build is still {}'.format(build_details['lifecycle']))
+    return build_details, getattr(r_2, 'from_cache', False)
+
+
+def build_actions(build_details):
+    """Yields the job and action number, step and action of every action with a log."""
+    for job, step in enumerate(build_details.get('steps') or []):
+        for a, action in enumerate(step.get('actions') or []):
+            if 'output_url' in action:
+                yield job, a, step, action
+
+
+def download_build(i, downloads, done):
+    with metrics.timed('build_seconds'):
+        build_details, cached = get_build_details(i)
+        if build_details is None:
+            return 'missing', []
+        pending = {}
+        filtered = False
+        for job, a, step, action in build_actions(build_details):
+            # logs an earlier filtered run already has are left alone
+            if (job, a) in done:
+                continue
+            if not wanted_step(step, action):
+                avoid('step_logs')
+                filtered = True
+                continue
+            pending[(job, a)] = downloads.submit(download_action, action['output_url'], i, job, a, cached)
+        actions = []
+        expired = []
+        for key, future in pending.items():
+            try:
+                actions.append(future.result())
+            except OutputUrlExpired:
+                expired.append(key)
+        if expired:
+            # fresh details have freshly signed output_urls, a 403 from one of those really is a removed log
+            print('Log URLs of build {} from the cache were refused, checking the build again ...'.format(i))
+            build_details, cached = get_build_details(i, fresh=True)
+            if build_details is None:
+                return 'missing', []
+            urls = dict(((job, a), action['output_url']) for job, a, step, action in build_actions(build_details))
+            retried = [downloads.submit(download_action, urls[(job, a)], i, job, a) for job, a in expired if (job, a) in urls]
+            actions += [future.result() for future in retried]
+        # a build missing any filtered logs isn't complete, so a later run without the filters still gets them
+        if filtered or None in actions:
+            return 'filtered', [action for action in actions if action]
+        return 'complete', actions
+
+
+LIST_LIMIT = 100
+
+
+def stop_time(build):
+    if not build.get('stop_time'):
+        return None
+    return datetime.fromisoformat(build['stop_time'].replace('Z', '+00:00'))
+
+
+def in_bounds(build):
+    for bound, outside in ((since, lambda a, b: a < b), (until, lambda a, b: a > b)):
+        if isinstance(bound, int) and outside(build['build_num'], bound):
+            return False
+        if isinstance(bound, datetime) and (stop_time(build) is None or outside(stop_time(build), bound)):
+            return False
+    return True
+
+
+def wanted_builds(builds):
+    """Returns the build_nums of the builds the branch, status and per branch filters allow, skipping the rest before any request."""
+    wanted = []
+    per_branch = Counter()
+    for build in builds:
+        if args.branch and not any(fnmatch(build.get('branch') or '', pattern) for pattern in args.branch):
+            continue
+        if args.status and build.get('status') not in args.status:
+            continue
+        # the listing is newest first, so the first builds of each branch seen are the newest
+        if args.per_branch:
+            per_branch[build.get('branch')] += 1
+            if per_branch[build.get('branch')] > args.per_branch:
+                continue
+        wanted.append(build['build_num'])
+    return wanted
+
+
+def list_builds(stop_at):
+    """Pages through the project's builds, newest first, down to (but excluding) build stop_at.
+
+    Returns the listed builds and the lowest build_num the listing was read down to.
+    """
+    listed = []
+    offset = 0
+    while True:
+        print('Listing builds {}-{} of {} ...'.format(offset, offset + LIST_LIMIT, url))
+        # the listing is how new builds are found, so it is never served from the cache
+        r = s_circle.get(url, params=dict(params, limit=LIST_LIMIT, offset=offset, shallow='true'), headers={'Cache-Control': 'no-cache'})
+        if not r.status_code == 200:
+            print('API request failed with code: {}'.format(r.status_code))
+            exit(1)
+        page = r.json()
+        if len(page) == 0:
+            return listed, stop_at
+        for build in page:
+            if build['build_num'] <= stop_at:
+                return listed, stop_at
+            listed.append(build)
+        if len(page) < LIST_LIMIT:
+            return listed, stop_at
+        # nothing older than the lower bound can be in range, so stop paging once a whole page is below it
+        if isinstance(since, int) and page[-1]['build_num'] < since:
+            return listed, page[-1]['build_num']
+        if isinstance(since, datetime) and all(stop_time(b) and stop_time(b) < since for b in page):
+            return listed, page[-1]['build_num']
+        offset += len(page)
+
+
+manifest = Manifest('{}/manifest.sqlite'.format(outfiles))
+synced = manifest.synced_builds()
+synced_through = manifest.synced_through()
+
+if args.build:
+    # the builds were already listed by whoever asked for them, and another worker may have synced some since
+    todo = [i for i in args.build if i not in synced]
+    print('Downloading {} builds, skipping {} already synced ...'.format(len(todo), len(args.build) - len(todo)))
+else:
+    listed, listed_to = list_builds(synced_through)
+
+    # build numbers in the listed range that the listing doesn't have were deleted or never existed
+    if listed:
+        gaps = set(range(listed_to + 1, listed[0]['build_num'])) - set(b['build_num'] for b in listed) - synced
+        manifest.record_missing(gaps)
+        synced |= gaps
+
+    unsynced = [b for b in listed if b['build_num'] not in synced and in_bounds(b)]
+    # the filters pick from the whole listing, so --per-branch counts synced builds too rather than reaching further back each run
+    wanted = set(wanted_builds([b for b in listed if in_bounds(b)]))
+    todo = [b['build_num'] for b in unsynced if b['build_num'] in wanted]
+    avoid('builds', len(unsynced) - len(todo))
+    print('Found {} builds, skipping {} already synced or out of range ...'.format(len(listed), len(listed) - len(unsynced)))
+
+if args.list_to:
+    manifest.advance(synced)
+    with open(args.list_to, 'w') as f:
+        json.dump(todo, f)
+    print('Listed {} builds to download in {} ...'.format(len(todo), args.list_to))
+    exit(0)
+
+done = manifest.filtered_actions()
+
+# build details and action outputs get separate pools, so a build waiting on its downloads never starves them
+try:
+    with ThreadPoolExecutor(max_workers=workers) as build_pool, ThreadPoolExecutor(max_workers=workers) as download_pool:
+        futures = {}
+        for i in todo:
+            futures[build_pool.submit(download_build, i, download_pool, done.get(i, set()))] = i
+
+        try:
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    state, actions = future.result()
+                except (requests.exceptions.RequestException, IncompleteBuild) as e:
+                    print('Failed to download build {}, it will be retried on the next run: {}'.format(i, e))
+                    continue
+                with metrics.timed('manifest_seconds'):
+                    manifest.record_build(i, state, actions)
+                if state != 'filtered':
+                    synced.add(i)
+        except BaseException:
+            # on Ctrl-C the queued builds and logs are dropped, rather than all requested before the pools can shut down
+            stopping.set()
+            build_pool.shutdown(wait=False, cancel_futures=True)
+            download_pool.shutdown(wait=False, cancel_futures=True)
+            raise
+finally:
+    manifest.advance(synced)
+    if args.step or args.branch or args.status or args.per_branch or args.max_size:
+        # builds skipped from the listing save their details request and an unknown number of log requests,
+        # and only --max-size skips know how big a log was, the build details don't give the size of the rest
+        print('Filters skipped {} builds, {} logs by step and {} logs over --max-size, avoiding {} requests and {:.1f} MB of logs over --max-size ...'.format(
+            avoided['builds'], avoided['step_logs'], avoided['large_logs'],
+            avoided['builds'] + avoided['step_logs'], avoided['large_bytes'] / 1024 / 1024
+        ))
+    if args.storage == 'objects':
+        print('Stored {} new logs, {} were already stored ...'.format(store.stored, store.deduplicated))
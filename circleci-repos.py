@@ -1,7 +1,14 @@
 import requests
 import json
 import os
+import sys
+import threading
 from argparse import ArgumentParser
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import circleci_http
+import circleci_metrics
 
 
 parser = ArgumentParser(description="Checks a Github org for repos, or members of the org with personal repos, which have projects on CircleCI")
@@ -9,9 +16,13 @@ parser.add_argument("-o", "--org", help="Github org to check")
 parser.add_argument("-t", "--token", help="Github token for authenticated API requests, used in the Authorization header")
 parser.add_argument("-c", "--circle-token", help="CircleCI token for authenticated API requests")
 parser.add_argument("-m", "--members-only", action="store_true", help="Collect the org members and their repos on CircleCI")
+parser.add_argument("-w", "--workers", type=int, default=10, help="Number of repos to check on CircleCI concurrently")
 parser.add_argument("-v", "--verbose", action="store_true", help="More output")
+circleci_http.add_arguments(parser)
+circleci_metrics.add_arguments(parser)
 
 args = parser.parse_args()
+circleci_metrics.start(args)
 
 if not args.org:
     print('Must supply a org value')
@@ -22,115 +33,140 @@ members_only = args.members_only
 verbose = args.verbose
 token = args.token
 circle_token = args.circle_token
+workers = args.workers
+
+if workers < 1:
+    print('Workers must be at least 1')
+    exit(1)
 
 github_repos = []
 headers = {}
 if token:
     headers['Authorization'] = 'token %s' % (token)
 
-s_github = requests.session()
+# repeat runs revalidate cached pages with ETags, unchanged pages come back as 304s which don't use rate limit
+s_github = circleci_http.session(args, workers)
+
+# CircleCI projects are checked by a pool as the Github repos are found, rather than after collection finishes
+circle_projects = []
+s_circle = circleci_http.session(args, workers)
+params = {'limit': 1}
+if circle_token:
+    params['circle-token'] = circle_token
+print_lock = threading.Lock()
+probes = ThreadPoolExecutor(max_workers=workers)
+
+
+def check_circle_project(pair):
+    if verbose:
+        print('Trying %s' % (pair['repo']))
+    url = '%s/project/github/%s/%s' % (args.circleci_url, pair['org'], pair['repo'])
+    try:
+        res = s_circle.get(url, params=params)
+    except requests.exceptions.RequestException as e:
+        print('Failed to check %s/%s: %s' % (pair['org'], pair['repo'], e), file=sys.stderr)
+        return
+    if res.status_code == 404:
+        return
+    # retries can run out on 429s and errors, whose bodies are error messages rather than builds
+    if res.status_code != 200:
+        print('Failed to check %s/%s, CircleCI API request failed with code: %s' % (pair['org'], pair['repo'], res.status_code), file=sys.stderr)
+        return
+    data = res.json()
+    if len(data) > 0:
+        with print_lock:
+            circle_projects.append(pair)
+            if verbose:
+                print('Found %s/%s' % (pair['org'], pair['repo']))
+            print('%s/%s' % (pair['org'], pair['repo']), flush=True)
+
+
+def add_github_repo(pair):
+    github_repos.append(pair)
+    probes.submit(check_circle_project, pair)
+
+
+if verbose:
+    print('Collecting Github repos and CircleCI projects...')
+
+PER_PAGE = 100
+
+github_pages = ThreadPoolExecutor(max_workers=workers)
+
+
+def last_page(res, default):
+    if 'last' not in res.links:
+        return default
+    return int(parse_qs(urlparse(res.links['last']['url']).query)['page'][0])
+
+
+def github_page(url, page):
+    """Gets one page of a Github list, returning the items and the number of the last page."""
+    # retries and rate limits are handled by the session, so a failure here is final
+    try:
+        res = s_github.get(url, headers=headers, params={'per_page': PER_PAGE, 'page': page})
+    except requests.exceptions.RequestException as e:
+        print('Failed to get %s page %s: %s' % (url, page, e), file=sys.stderr)
+        return [], page
+    if res.status_code != 200:
+        print('Failed to get %s page %s, status code %s' % (url, page, res.status_code), file=sys.stderr)
+        return [], page
+    return res.json(), last_page(res, page)
+
+
+def github_list(url):
+    """Yields every item of a paginated Github list, fetching the pages after the first in parallel."""
+    data, last = github_page(url, 1)
+    pages = [github_pages.submit(github_page, url, page) for page in range(2, last + 1)]
+    yield from data
+    for future in pages:
+        yield from future.result()[0]
+
 
 # collect all the relevant Github org/member and repo pairs
 if not members_only:
-    has_repos = True
-    page = 1
-    while has_repos:
-        if verbose:
-            print('Getting repos in %s...' % (org))
-        data = []
-        try:
-            res = s_github.get('https://api.github.com/orgs/%s/repos' % (org), headers=headers, params={'page': page })
-            data = res.json()
-        except requests.exceptions.ConnectionError as e:
-            continue
-        if len(data) > 0:
-            for repo in data:
-                if 'name' in repo:
-                    github_repos.append({'org': org, 'repo': repo['name']})
-                    if verbose:
-                        print('Found repo %s' % (repo['name']))
-        else:
-            has_repos = False
+    if verbose:
+        print('Getting repos in %s...' % (org))
+    for repo in github_list('%s/orgs/%s/repos' % (args.github_url, org)):
+        if 'name' in repo:
+            add_github_repo({'org': org, 'repo': repo['name']})
             if verbose:
-                print('Done collecting org repos')
-        page += 1
+                print('Found repo %s' % (repo['name']))
+    if verbose:
+        print('Done collecting org repos')
     if len(github_repos) == 0 and verbose:
         print('No repos found in %s...' % (org))
 else:
     members = []
-    has_members = True
-    page = 1
-    while has_members:
-        if verbose:
-            print('Getting members in %s...' % (org))
-        data = []
-        try:
-            res = s_github.get('https://api.github.com/orgs/%s/members' % (org), headers=headers, params={'page': page })
-            data = res.json()
-        except requests.exceptions.ConnectionError as e:
-            continue
-        if len(data) > 0:
-            for repo in data:
-                if 'login' in repo:
-                    members.append(repo['login'])
-                    if verbose:
-                        print('Found member %s' % (repo['login']))
-        else:
-            has_members = False
+    if verbose:
+        print('Getting members in %s...' % (org))
+    for member in github_list('%s/orgs/%s/members' % (args.github_url, org)):
+        if 'login' in member:
+            members.append(member['login'])
             if verbose:
-                print('Done collecting members')
-        page += 1
+                print('Found member %s' % (member['login']))
+    if verbose:
+        print('Done collecting members')
     if len(members) == 0 and verbose:
         print('No members found in %s...' % (org))
-    
+
     for member in members:
-        has_repos = True
-        page = 1
-        while has_repos:
-            if verbose:
-                print('Getting repos in member %s...' % (member))
-            data = []
-            try:
-                res = s_github.get('https://api.github.com/users/%s/repos' % (member), headers=headers, params={'page': page })
-                data = res.json()
-            except requests.exceptions.ConnectionError as e:
-                continue
-            if len(data) > 0:
-                for repo in data:
-                    if 'name' in repo:
-                        github_repos.append({'org': member, 'repo': repo['name']})
-                        if verbose:
-                            print('Found repo %s for member %s' % (repo['name'], member))
-            else:
-                has_repos = False
+        if verbose:
+            print('Getting repos in member %s...' % (member))
+        for repo in github_list('%s/users/%s/repos' % (args.github_url, member)):
+            if 'name' in repo:
+                add_github_repo({'org': member, 'repo': repo['name']})
                 if verbose:
-                    print('Done collecting member repos')
-            page += 1
+                    print('Found repo %s for member %s' % (repo['name'], member))
+        if verbose:
+            print('Done collecting member repos')
         if len(github_repos) == 0 and verbose:
             print('No repos found in member %s...' % (member))
 
-# check the repos for a CircleCI project
-circle_projects = []
-s_circle = requests.session()
-params = {'limit': 1}
-if circle_token:
-	params['circle-token'] = circle_token
-if verbose:
-    print('Trying to collect CircleCI projects...')
-for pair in github_repos:
-    if verbose:
-        print('Trying %s' % (pair['repo']))
-    url = 'https://circleci.com/api/v1.1/project/github/%s/%s' % (pair['org'], pair['repo'])
-    res = s_circle.get(url, params=params)
-    if res.status_code != 404:
-        data = res.json()
-        if len(data) > 0:
-            circle_projects.append(pair)
-            if verbose:
-                print('Found %s/%s' % (pair['org'], pair['repo']))
+github_pages.shutdown(wait=True)
+
+# wait for the remaining CircleCI checks, found projects are printed as each check completes
+probes.shutdown(wait=True)
 
 if len(circle_projects) == 0 and verbose:
     print('No CircleCI projects found')
-
-for pair in circle_projects:
-    print('%s/%s' % (pair['org'], pair['repo']))
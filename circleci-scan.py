@@ -0,0 +1,172 @@
+import bisect
+import json
+import math
+import mmap
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from collections import Counter
+from multiprocessing import Pool
+
+import circleci_store
+
+
+# each rule is a bytes pattern, the combined matcher tries them all in a single pass over each file
+RULES = [
+    ('aws_access_key_id', rb'(?:A3T[A-Z0-9]|AKIA|ASIA|ABIA|ACCA)[A-Z0-9]{16}'),
+    ('aws_secret_access_key', rb'(?i:aws_?secret_?access_?key)["\']?\s*[=:]\s*["\']?[A-Za-z0-9/+=]{40}'),
+    ('github_token', rb'gh[pousr]_[A-Za-z0-9]{36,255}'),
+    ('github_fine_grained_token', rb'github_pat_[A-Za-z0-9_]{82}'),
+    ('gitlab_token', rb'glpat-[A-Za-z0-9_\-]{20}'),
+    ('slack_token', rb'xox[abposr]-[0-9A-Za-z\-]{10,72}'),
+    ('slack_webhook', rb'https://hooks\.slack\.com/services/T[A-Za-z0-9_]+/B[A-Za-z0-9_]+/[A-Za-z0-9_]+'),
+    ('npm_token', rb'npm_[A-Za-z0-9]{36}'),
+    ('google_api_key', rb'AIza[0-9A-Za-z\-_]{35}'),
+    ('stripe_secret_key', rb'[rs]k_live_[0-9A-Za-z]{24,}'),
+    ('private_key', rb'-----BEGIN (?:RSA |EC |DSA |OPENSSH |PGP |ENCRYPTED )?PRIVATE KEY(?: BLOCK)?-----'),
+]
+
+MATCHER = re.compile(b'|'.join(b'(?P<%s>%s)' % (name.encode(), pattern) for name, pattern in RULES))
+
+# a secret looking name assigned a value, only reported if the value has high enough entropy and no rule above found it.
+# it starts matching at the name, before the value, so it has its own pass rather than shadowing the rules in MATCHER
+HIGH_ENTROPY = re.compile(
+    rb'(?i:secret|token|passw(?:or)?d|api_?key|access_?key|auth)[A-Za-z0-9_.\-]{0,20}["\']?\s*[=:]\s*["\']?(?P<value>[A-Za-z0-9+/=_\-]{16,128})'
+)
+
+# compressed logs can't be mmap'd, so they are scanned in chunks that overlap by more than the longest match
+CHUNK_SIZE = 8 * 1024 * 1024
+CHUNK_OVERLAP = 4096
+
+min_entropy = 3.5
+
+
+def set_min_entropy(value):
+    global min_entropy
+    min_entropy = value
+
+
+def entropy(value):
+    counts = Counter(value)
+    return -sum(c / len(value) * math.log2(c / len(value)) for c in counts.values())
+
+
+def count_lines(buf, start, end):
+    # mmap views have no count(), so count in bounded slices rather than copying the whole gap at once
+    lines = 0
+    while start < end:
+        lines += bytes(buf[start:min(end, start + CHUNK_SIZE)]).count(b'\n')
+        start += CHUNK_SIZE
+    return lines
+
+
+def high_entropy_matches(buf, limit, starts, ends):
+    """Yields high entropy values that start before limit, skipping those overlapping a match from starts and ends."""
+    pos = 0
+    while True:
+        m = HIGH_ENTROPY.search(buf, pos)
+        if m is None or m.start() >= limit:
+            return
+        if entropy(m.group('value')) < min_entropy:
+            # the rejected value can still hold a name and value of its own, so it is searched again
+            pos = m.start('value')
+            continue
+        pos = m.end()
+        i = bisect.bisect_left(starts, m.end('value')) - 1
+        if i < 0 or ends[i] <= m.start('value'):
+            yield m.start(), 'high_entropy', m.group(0)
+
+
+def scan_buffer(buf, base_offset, base_line, limit):
+    """Yields (rule, offset, line, match) for matches in buf that start before limit."""
+    matches = []
+    for m in MATCHER.finditer(buf):
+        if m.start() >= limit:
+            break
+        matches.append((m.start(), m.end(), m.lastgroup, m.group(0)))
+    starts = [start for start, end, rule, match in matches]
+    ends = [end for start, end, rule, match in matches]
+    found = [(start, rule, match) for start, end, rule, match in matches]
+    found.extend(high_entropy_matches(buf, limit, starts, ends))
+    found.sort(key=lambda f: f[0])
+    line = base_line
+    last = 0
+    for start, rule, match in found:
+        line += count_lines(buf, last, start)
+        last = start
+        yield rule, base_offset + start, line, match
+
+
+def scan_stream(f):
+    findings = []
+    buf = b''
+    offset = 0
+    line = 1
+    eof = False
+    while not eof:
+        chunk = f.read(CHUNK_SIZE)
+        eof = not chunk
+        buf += chunk
+        # only take matches from the part of the buffer the next chunk can't extend, the rest is carried over
+        limit = len(buf) if eof else max(len(buf) - CHUNK_OVERLAP, 0)
+        findings.extend(scan_buffer(buf, offset, line, limit))
+        line += buf.count(b'\n', 0, limit)
+        offset += limit
+        buf = buf[limit:]
+    return findings
+
+
+def scan_log(log):
+    if log.compressed:
+        with log.open() as f:
+            return log, scan_stream(f)
+    if log.length == 0:
+        return log, []
+    # uncompressed logs are scanned in place, whether they have a file to themselves or are in a pack
+    with open(log.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # the views have to be released before the mmap can be closed
+        with memoryview(mm) as view, view[log.offset:log.offset + log.length] as buf:
+            return log, list(scan_buffer(buf, 0, 1, len(buf)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Scans logs downloaded by circleci-logs.py for keys and tokens, writing findings as JSONL.")
+    parser.add_argument("-d", "--directory", default="out/circleci", help="Directory circleci-logs.py wrote logs to")
+    parser.add_argument("-p", "--project", help="Only scan this project, in the format of org/repo")
+    parser.add_argument("-o", "--output", help="File to write findings to, defaults to stdout")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Number of processes to scan with")
+    parser.add_argument("-e", "--min-entropy", type=float, default=min_entropy, help="Minimum Shannon entropy for the high_entropy rule")
+    parser.add_argument("-v", "--verbose", action="store_true", help="More output")
+
+    args = parser.parse_args()
+
+    root = args.directory
+    scan_root = os.path.join(root, *args.project.split('/')) if args.project else root
+    if not os.path.isdir(scan_root):
+        print('Could not find downloaded logs in %s' % (scan_root))
+        exit(1)
+
+    # identical logs, such as checkouts and environment setup, are only scanned once and their findings reported for each copy
+    unique, copies = circleci_store.unique_logs(circleci_store.iter_logs(root, args.project))
+    if args.verbose:
+        print('Scanning %s unique logs of %s...' % (len(unique), len(unique) + sum(len(logs) - 1 for logs in copies.values())), file=sys.stderr)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    scanned = 0
+    found = 0
+    with Pool(args.workers, initializer=set_min_entropy, initargs=(args.min_entropy,)) as pool:
+        for log, findings in pool.imap_unordered(scan_log, unique, chunksize=64):
+            scanned += 1
+            for copy in copies.get(log.digest, [log]):
+                for rule, offset, line, match in findings:
+                    finding = {'org': copy.org, 'repo': copy.repo, 'build': copy.build, 'job': copy.job}
+                    finding.update({'rule': rule, 'offset': offset, 'line': line, 'match': match.decode(errors='replace')})
+                    out.write(json.dumps(finding) + '\n')
+                    found += 1
+            if args.verbose and scanned % 10000 == 0:
+                print('Scanned %s logs...' % (scanned), file=sys.stderr)
+    if out is not sys.stdout:
+        out.close()
+    if args.verbose:
+        print('Scanned %s unique logs, %s findings' % (scanned, found), file=sys.stderr)
@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import sys
+from argparse import ArgumentParser
+
+import circleci_store
+
+
+def cat(args):
+    if '/' not in args.project:
+        print('Project must be in the format org/repo')
+        exit(1)
+    org, repo = args.project.split('/')[:2]
+    log = circleci_store.find_log(args.directory, org, repo, args.build, args.job)
+    if log is None:
+        print('Could not find %s/%s/%s/%s in %s' % (org, repo, args.build, args.job, args.directory), file=sys.stderr)
+        exit(1)
+    with log.open() as f:
+        shutil.copyfileobj(f, sys.stdout.buffer)
+
+
+def ls(args):
+    for log in circleci_store.iter_logs(args.directory, args.project):
+        if args.json:
+            print(json.dumps({
+                'org': log.org, 'repo': log.repo, 'build': log.build, 'job': log.job, 'path': log.path,
+                'offset': log.offset, 'length': log.length, 'compressed': log.compressed
+            }))
+        else:
+            print('%s/%s %s %s' % (log.org, log.repo, log.build, log.job))
+
+
+def dedupe_stats(actions):
+    sizes = dict((digest, size) for path, digest, size in actions if digest)
+    total = sum(size for path, digest, size in actions if digest)
+    unique = sum(sizes.values())
+    return {
+        'logs': len(actions), 'unique_logs': len(sizes), 'bytes': total, 'unique_bytes': unique,
+        'ratio': round(total / unique, 2) if unique else 1.0
+    }
+
+
+def print_stats(name, stats, as_json):
+    if as_json:
+        print(json.dumps(dict({'project': name}, **stats)))
+    else:
+        print('%s: %s logs, %s unique, %.1f MB, %.1f MB unique, %.2fx' % (
+            name, stats['logs'], stats['unique_logs'], stats['bytes'] / 1024 / 1024, stats['unique_bytes'] / 1024 / 1024, stats['ratio']
+        ))
+
+
+def dedupe(args):
+    if args.project and '/' not in args.project:
+        print('Project must be in the format org/repo')
+        exit(1)
+    projects = [tuple(args.project.split('/')[:2])] if args.project else circleci_store.projects(args.directory)
+    everything = []
+    for org, repo in projects:
+        actions = list(circleci_store.manifest_actions(os.path.join(args.directory, org, repo)).values())
+        if not actions:
+            continue
+        print_stats('%s/%s' % (org, repo), dedupe_stats(actions), args.json)
+        everything += actions
+    # logs are stored once across every project with --storage objects, so the overall ratio can beat each project's
+    if not args.project:
+        print_stats('total', dedupe_stats(everything), args.json)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Reads logs downloaded by circleci-logs.py, whether they were stored as files or packed.")
+    parser.add_argument("-d", "--directory", default="out/circleci", help="Directory circleci-logs.py wrote logs to")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    cat_parser = subparsers.add_parser("cat", help="Write a single job log to stdout, decompressed")
+    cat_parser.add_argument("project", help="Project the log is from, in the format of org/repo")
+    cat_parser.add_argument("build", type=int, help="Build number")
+    cat_parser.add_argument("job", help="Job log name, in the format of job-X-Y")
+    cat_parser.set_defaults(func=cat)
+
+    ls_parser = subparsers.add_parser("ls", help="List the downloaded logs")
+    ls_parser.add_argument("project", nargs="?", help="Only list this project, in the format of org/repo")
+    ls_parser.add_argument("-j", "--json", action="store_true", help="Output as JSONL, with where each log is stored")
+    ls_parser.set_defaults(func=ls)
+
+    dedupe_parser = subparsers.add_parser("dedupe", help="Report how many of the downloaded logs are identical, from the manifests")
+    dedupe_parser.add_argument("project", nargs="?", help="Only report this project, in the format of org/repo")
+    dedupe_parser.add_argument("-j", "--json", action="store_true", help="Output as JSONL")
+    dedupe_parser.set_defaults(func=dedupe)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -2,13 +2,29 @@ import requests
 import pendulum
 import json
 import re
+import codecs
+import sys
+import threading
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import circleci_http
+import circleci_metrics
+from circleci_metrics import metrics
 
 
 class GetBuildSecretsException(Exception):
     pass
 
 
+class ProjectCheckException(Exception):
+    pass
+
+
+class BuildCancelledException(Exception):
+    pass
+
+
 parser = ArgumentParser(description="Checks a CircleCI project for signs of vulnerable configuration in regards to fork behaviour and secrets")
 parser.add_argument("-p", "--project", help="The repo/project to inspect, in the format of org/repo")
 parser.add_argument("-c", "--circleci-token", help="The CircleCI API token for non public readable builds")
@@ -16,94 +32,109 @@ parser.add_argument("-g", "--github-token", help="The Github API token")
 parser.add_argument("-i", "--ignore-users", help="Ignore specific Github users from the forked PR collection, comma separated")
 parser.add_argument("-a", "--check-all", action="store_true", help="Go through all found CircleCI builds even if secret usage was already found")
 parser.add_argument("-o", "--open-only", action="store_true", help="Only check currently open PRs")
+parser.add_argument("-f", "--projects-file", help="File of org/repo projects to check, one per line, or - for stdin. Verdicts are written as JSONL")
+parser.add_argument("-w", "--workers", type=int, default=10, help="Number of projects to check concurrently with --projects-file")
 parser.add_argument("-v", "--verbose", action="store_true", help="More output")
+circleci_http.add_arguments(parser)
+circleci_metrics.add_arguments(parser)
 
 args = parser.parse_args()
+circleci_metrics.start(args)
 
-if not args.project:
-    print('Must supply a project value')
+if not args.project and not args.projects_file:
+    print('Must supply a project or projects file value')
+    exit(1)
+
+if args.workers < 1:
+    print('Workers must be at least 1')
     exit(1)
 
-project = args.project.split('/')[0]
-repo = args.project.split('/')[1]
 token = args.circleci_token
 github_token = args.github_token
 ignore_users = args.ignore_users
 check_all_circleci_builds = args.check_all
 open_only = args.open_only
 verbose = args.verbose
+# in batch mode stdout is the JSONL verdicts, so progress goes to stderr
+progress = sys.stderr if args.projects_file else sys.stdout
+workers = args.workers
 
-print('Trying %s/%s...' % (project, repo))
-
-# collect the 10 most recent PRs from forks for the Github repo
-s_github = requests.session()
+# the sessions are shared by every project checked, so connections are pooled across them
+s_github = circleci_http.session(args, workers)
+s_circle = circleci_http.session(args, workers)
+s_s3 = circleci_http.session(args, workers)
+# status lookups and build checks from every project run here, so workers bounds the requests in flight
+stage_pool = ThreadPoolExecutor(max_workers=workers)
 gh_headers = {}
 if github_token:
     gh_headers['Authorization'] = 'token %s' % (github_token)
-page = 1
-gh_prs = []
-gh_pr_state = 'open' if open_only else 'all'
-if open_only and verbose:
-    print('Collecting PRs that are open only')
-while True:
-    if page > 20:
+
+
+# collect the 10 most recent PRs from forks for the Github repo
+def forked_prs(project, repo):
+    page = 1
+    gh_prs = []
+    gh_pr_state = 'open' if open_only else 'all'
+    if open_only and verbose:
+        print('Collecting PRs that are open only', file=progress)
+    while True:
+        if page > 20:
+            if verbose:
+                print('Stopping PR collection after checking 20 pages of PRs', file=progress)
+            break
         if verbose:
-            print('Stopping PR collection after checking 20 pages of PRs')
-        break
-    if verbose:
-        print("Getting page %s for %s/%s PRs..." % (page, project, repo))
-    res = s_github.get('https://api.github.com/repos/%s/%s/pulls' % (project, repo), headers=gh_headers, params={'page': page, 'state': gh_pr_state })
-    data = res.json()
-    if len(data) > 0:
-        for pr in data:
-            pr_user = pr['user']['login'] if 'user' in pr and 'login' in pr['user'] else ''
-            if pr_user and ignore_users and pr_user in ignore_users.split(','):
-                if verbose:
-                    print('Ignoring PR from %s' % (pr_user))
-                continue
-            if (
-                pr and 'head' in pr and pr['head'] and 'repo' in pr['head'] and pr['head']['repo'] and 'sha' in pr['head'] and
-                'fork' in pr['head']['repo'] and pr['head']['repo']['fork']
-            ):
-                # if the PR author is publicly known as a privileged user for this repo, skip
-                if pr['author_association'] in ['OWNER', 'MEMBER']:
+            print("Getting page %s for %s/%s PRs..." % (page, project, repo), file=progress)
+        res = s_github.get('%s/repos/%s/%s/pulls' % (args.github_url, project, repo), headers=gh_headers, params={'page': page, 'state': gh_pr_state })
+        if res.status_code != 200:
+            raise ProjectCheckException('Failed to collect PRs, Github API request failed with code: %s' % (res.status_code))
+        data = res.json()
+        if len(data) > 0:
+            for pr in data:
+                pr_user = pr['user']['login'] if 'user' in pr and 'login' in pr['user'] else ''
+                if pr_user and ignore_users and pr_user in ignore_users.split(','):
                     if verbose:
-                        print('Ignoring PR %s, author "%s" is a %s' % (pr['number'], pr_user, pr['author_association']))
+                        print('Ignoring PR from %s' % (pr_user), file=progress)
                     continue
-                gh_prs.append(
-                    {
+                if (
+                    pr and 'head' in pr and pr['head'] and 'repo' in pr['head'] and pr['head']['repo'] and 'sha' in pr['head'] and
+                    'fork' in pr['head']['repo'] and pr['head']['repo']['fork']
+                ):
+                    # if the PR author is publicly known as a privileged user for this repo, skip
+                    if pr['author_association'] in ['OWNER', 'MEMBER']:
+                        if verbose:
+                            print('Ignoring PR %s, author "%s" is a %s' % (pr['number'], pr_user, pr['author_association']), file=progress)
+                        continue
+                    gh_prs.append(pr['number'])
+                    if verbose:
+                        print('Found PR %s (commit %s) from fork %s' % (pr['number'], pr['head']['sha'], pr['head']['repo']['full_name']), file=progress)
+                    yield {
                         'sha': pr['head']['sha'],
                         'number': pr['number'],
                         'user': pr_user,
                         'created_at': pr['created_at'] if 'created_at' in pr else None,
                         'merged_at': pr['merged_at'] if 'merged_at' in pr else None
                     }
-                )
-                if verbose:
-                    print('Found PR %s (commit %s) from fork %s' % (pr['number'], pr['head']['sha'], pr['head']['repo']['full_name']))
-                if len(gh_prs) >= 10:
-                    break
-    else:
-        if verbose:
-            print('Done collecting forked PRs')
-        break
-    if len(gh_prs) >= 10:
-        if verbose:
-            print('Done collecting forked PRs')
-        break
-    page += 1
+                    if len(gh_prs) >= 10:
+                        break
+        else:
+            if verbose:
+                print('Done collecting forked PRs', file=progress)
+            break
+        if len(gh_prs) >= 10:
+            if verbose:
+                print('Done collecting forked PRs', file=progress)
+            break
+        page += 1
 
-if len(gh_prs) == 0:
-    print('%s/%s: No builds found which came from a forked PR - unable to determine whether this project is vulnerable' % (project, repo))
-    exit(1)
 
-# collect the CircleCI build IDs from the Github statuses
-if verbose:
-    print('Collecting CircleCI build ids associated with the forked PRs...')
-forked_builds = []
-forked_builds_user_map = {}
-for pr in gh_prs:
-    res = s_github.get('https://api.github.com/repos/%s/%s/commits/%s/status' % (project, repo, pr['sha']), headers=gh_headers)
+# collect the CircleCI build IDs from the Github status of a forked PR's commit
+def status_builds(project, repo, pr):
+    res = s_github.get('%s/repos/%s/%s/commits/%s/status' % (args.github_url, project, repo, pr['sha']), headers=gh_headers)
+    if res.status_code != 200:
+        if verbose:
+            print('Failed to get the status of commit %s, Github API request failed with code: %s' % (pr['sha'], res.status_code), file=progress)
+        return []
+    builds = []
     data = res.json()
     if data and 'statuses' in data:
         for status in data['statuses']:
@@ -111,53 +142,204 @@ for pr in gh_prs:
                 build_num_matches = re.match(r'https:\/\/circleci\.com\/gh\/[^\/]+\/[^\/]+\/(\d+)', status['target_url'].lower())
                 if build_num_matches:
                     build_num = int(build_num_matches.group(1))
-                    if build_num not in forked_builds:
-                        pr_create_time = pendulum.parse(pr['created_at'])
-                        pr_merge_time = pendulum.parse(pr['merged_at']) if 'merged_at' in pr and pr['merged_at'] else None
-                        status_create_time = pendulum.parse(status['created_at']) if 'created_at' in status and status['created_at'] else None
-                        # if the PR is merged, check the time of the CircleCI build to make sure it isn't aligned with the merge
-                        if (
-                            pr_merge_time and
-                            status_create_time and
-                            status_create_time > pr_create_time.add(hours=1) and
-                            (
-                                status_create_time > pr_merge_time or
-                                status_create_time.add(hours=1) > pr_merge_time
-                            )
-                        ):
-                            if verbose:
-                                print('Skipping CircleCI build %s as it appears to have run on merge and not PR creation' % (build_num))
-                            continue
-                        if 'state' in status and status['state'] == 'pending':
-                            if verbose:
-                                print('Skipping CircleCI build %s due to being "pending" - try again soon for this build to be checked' % (build_num))
-                            continue
-                        forked_builds.append(build_num)
-                        # record the PR user, accoding to Github, for this CircleCI build number, for later comparison
-                        forked_builds_user_map[build_num] = pr['user']
+                    pr_create_time = pendulum.parse(pr['created_at'])
+                    pr_merge_time = pendulum.parse(pr['merged_at']) if 'merged_at' in pr and pr['merged_at'] else None
+                    status_create_time = pendulum.parse(status['created_at']) if 'created_at' in status and status['created_at'] else None
+                    # if the PR is merged, check the time of the CircleCI build to make sure it isn't aligned with the merge
+                    if (
+                        pr_merge_time and
+                        status_create_time and
+                        status_create_time > pr_create_time.add(hours=1) and
+                        (
+                            status_create_time > pr_merge_time or
+                            status_create_time.add(hours=1) > pr_merge_time
+                        )
+                    ):
                         if verbose:
-                            print('Found CircleCI build %s from PR %s (commit %s)' % (build_num, pr['number'], pr['sha']))
-                            print(
-                                '\tSeconds between PR %s creation and CircleCI job %s creation: %s' %
-                                (pr['number'], build_num, status_create_time.int_timestamp - pr_create_time.int_timestamp)
-                            )
-
-if len(forked_builds) == 0:
-    print('%s/%s: No CircleCI statuses found - unlikely to be vulnerable' % (project, repo))
-    exit(1)
+                            print('Skipping CircleCI build %s as it appears to have run on merge and not PR creation' % (build_num), file=progress)
+                        continue
+                    if 'state' in status and status['state'] == 'pending':
+                        if verbose:
+                            print('Skipping CircleCI build %s due to being "pending" - try again soon for this build to be checked' % (build_num), file=progress)
+                        continue
+                    builds.append((build_num, status_create_time.int_timestamp - pr_create_time.int_timestamp if status_create_time else None))
+    return builds
+
+
+def timed_stage(fn, *args):
+    with metrics.timed('stage_seconds', stage=fn.__name__):
+        return fn(*args)
+
+
+class ProjectPipeline:
+    """Runs a project's commit status lookups and build checks concurrently on stage_pool.
+
+    Status lookups start as each forked PR is found, and build checks as each CircleCI build is found. Once a
+    build with secrets is found, and --check-all isn't set, checks of older builds are cancelled as the result
+    can only come from that build or a newer one.
+    """
+
+    def __init__(self, project, repo):
+        self.project = project
+        self.repo = repo
+        self.cond = threading.Condition(threading.RLock())
+        self.running = 0
+        self.error = None
+        self.forked_builds = []
+        self.forked_builds_user_map = {}
+        self.build_futures = {}
+        self.build_secrets = {}
+        self.newest_with_secrets = None
+
+    def submit(self, callback, fn, *args):
+        with self.cond:
+            self.running += 1
+            future = stage_pool.submit(timed_stage, fn, *args)
+        future.add_done_callback(lambda future: self.done(future, callback))
+        return future
+
+    def done(self, future, callback):
+        try:
+            if not future.cancelled():
+                callback(future.result())
+        except BuildCancelledException:
+            metrics.add('builds_cancelled')
+        except GetBuildSecretsException as e:
+            if verbose:
+                print(e, file=progress)
+        except Exception as e:
+            with self.cond:
+                self.error = self.error or e
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.cond.notify_all()
+
+    def cancelled(self, build_num):
+        return not check_all_circleci_builds and self.newest_with_secrets is not None and build_num < self.newest_with_secrets
+
+    def found_pr(self, pr):
+        self.submit(lambda builds: self.found_builds(pr, builds), status_builds, self.project, self.repo, pr)
+
+    def found_builds(self, pr, builds):
+        with self.cond:
+            for build_num, seconds in builds:
+                if build_num in self.forked_builds:
+                    continue
+                if verbose and not self.forked_builds:
+                    print('%s/%s has evidence of forked pull requests creating CircleCI builds' % (self.project, self.repo), file=progress)
+                self.forked_builds.append(build_num)
+                # record the PR user, accoding to Github, for this CircleCI build number, for later comparison
+                self.forked_builds_user_map[build_num] = pr['user']
+                if verbose:
+                    print('Found CircleCI build %s from PR %s (commit %s)' % (build_num, pr['number'], pr['sha']), file=progress)
+                    print('\tSeconds between PR %s creation and CircleCI job %s creation: %s' % (pr['number'], build_num, seconds), file=progress)
+                if self.cancelled(build_num):
+                    continue
+                self.build_futures[build_num] = self.submit(
+                    lambda secrets, build_num=build_num: self.checked_build(build_num, secrets),
+                    get_build_secret_names, self.project, self.repo, build_num, self.forked_builds_user_map, self.cancelled
+                )
+
+    def checked_build(self, build_num, secrets):
+        with self.cond:
+            self.build_secrets[build_num] = secrets
+            if len(secrets) > 0 and not self.cancelled(build_num):
+                if self.newest_with_secrets is None or build_num > self.newest_with_secrets:
+                    self.newest_with_secrets = build_num
+                for other, future in self.build_futures.items():
+                    if self.cancelled(other):
+                        future.cancel()
+
+    def wait(self):
+        with self.cond:
+            while self.running > 0:
+                self.cond.wait()
+        if self.error:
+            raise self.error
 
-forked_builds.sort(reverse=True)
 
-if verbose:
-    print('%s/%s has evidence of forked pull requests creating CircleCI builds' % (project, repo))
+OUTPUT_CHUNK_SIZE = 16 * 1024
+OUTPUT_MESSAGE_START = re.compile(r'"message"\s*:\s*"')
+JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+def output_message_pieces(chunks):
+    """Yields the decoded first "message" string of a JSON action output, piece by piece as its chunks arrive."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    chunks = iter(chunks)
+    text = ''
+    for chunk in chunks:
+        text += decoder.decode(chunk)
+        start = OUTPUT_MESSAGE_START.search(text)
+        if start:
+            text = text[start.end():]
+            break
+        # keep enough to find the key if it was split between chunks
+        text = text[-32:]
+    else:
+        return
+
+    while True:
+        # decode as much of the string as is available, an escape cut off by the end of the chunk waits for the next one
+        i = 0
+        while i < len(text):
+            end = min(pos for pos in (text.find('"', i), text.find('\\', i), len(text)) if pos >= 0)
+            yield text[i:end]
+            i = end
+            if i == len(text) or i + 1 == len(text):
+                break
+            if text[i] == '"':
+                return
+            if text[i + 1] != 'u':
+                yield JSON_ESCAPES.get(text[i + 1], text[i + 1])
+                i += 2
+            elif i + 6 <= len(text):
+                yield chr(int(text[i + 2:i + 6], 16))
+                i += 6
+            else:
+                break
+        text = text[i:]
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        text += decoder.decode(chunk)
+
+
+def replace_escape(pieces, escape, replacement):
+    """Replaces a backslash escape in a stream of text pieces, holding back a trailing backslash in case the escape was split."""
+    carry = ''
+    for piece in pieces:
+        piece = carry + piece
+        carry = ''
+        if piece.endswith('\\'):
+            piece, carry = piece[:-1], piece[-1:]
+        yield piece.replace(escape, replacement)
+    yield carry
+
+
+def output_message_lines(chunks):
+    """Yields the lines of an action output's message, the same as json.loads(body)[0]['message'] with any further
+    escaped newlines turned into newlines and escaped carriage returns removed, but without holding it all in memory."""
+    line = ''
+    pieces = replace_escape(replace_escape(output_message_pieces(chunks), '\\n', "\n"), '\\r', "")
+    for piece in pieces:
+        lines = (line + piece).split('\n')
+        for complete in lines[:-1]:
+            yield join_surrogates(complete)
+        line = lines[-1]
+    yield join_surrogates(line)
+
+
+def join_surrogates(line):
+    # \\u escapes of characters outside the BMP decode to surrogate pairs, which json.loads would have joined
+    return line.encode('utf-16', 'surrogatepass').decode('utf-16', 'replace')
 
-circleci_url = 'https://circleci.com/api/v1.1/project/github/%s/%s' % (project, repo)
-s_circle = requests.session()
 
 # collect the relevant logs of the supplied build number and look for evidence of secrets being available
-def get_build_secret_names(build_num):
+def get_build_secret_names(project, repo, build_num, forked_builds_user_map, cancelled, fresh=False):
     if verbose:
-        print('Checking build %s...' % (build_num))
+        print('Checking build %s...' % (build_num), file=progress)
     s3_file_url = ''
 
     found_prepare_env_var_action = False
@@ -165,7 +347,11 @@ def get_build_secret_names(build_num):
     params = {}
     if token:
         params['circle-token'] = token
-    r = s_circle.get('%s/%s' % (circleci_url, build_num), params=params)
+    circleci_url = '%s/project/github/%s/%s' % (args.circleci_url, project, repo)
+    headers = {'Cache-Control': 'no-cache'} if fresh else None
+    r = s_circle.get('%s/%s' % (circleci_url, build_num), params=params, headers=headers)
+    if r.status_code != 200:
+        raise GetBuildSecretsException('%s/%s: CircleCI API request for build %s failed with code: %s' % (project, repo, build_num, r.status_code))
     build_details = r.json()
 
     if 'user' in build_details and 'is_user' in build_details['user'] and build_details['user']['is_user'] and 'login' in build_details['user']:
@@ -182,7 +368,7 @@ def get_build_secret_names(build_num):
                 for a, action in enumerate(step['actions']):
                     if 'name' in action and action['name'] and 'preparing environment variables' in action['name'].lower():
                         if verbose:
-                            print('Found "Preparing Environment Variables" job')
+                            print('Found "Preparing Environment Variables" job', file=progress)
                         found_prepare_env_var_action = True
                         if 'output_url' in action:
                             s3_file_url = action['output_url']
@@ -193,13 +379,13 @@ def get_build_secret_names(build_num):
         # try the legacy action if the current action with env vars wasn't found
         if not found_prepare_env_var_action:
             if verbose:
-                print('Did not find a "Preparing Environment Variables" job, trying for "Spin up Environment" ...')
+                print('Did not find a "Preparing Environment Variables" job, trying for "Spin up Environment" ...', file=progress)
             for job, step in enumerate(build_details['steps']):
                 if 'actions' in step and len(step['actions']) > 0:
                     for a, action in enumerate(step['actions']):
                         if 'name' in action and action['name'] and 'spin up environment' in action['name'].lower():
                             if verbose:
-                                print('Found "Spin up Environment" job')
+                                print('Found "Spin up Environment" job', file=progress)
                             found_spin_up_env_action = True
                             if 'output_url' in action:
                                 s3_file_url = action['output_url']
@@ -214,63 +400,133 @@ def get_build_secret_names(build_num):
     if not s3_file_url:
         raise GetBuildSecretsException('%s/%s: Failed to get S3 download URL for environment variable job output' % (project, repo))
 
+    if cancelled(build_num):
+        raise BuildCancelledException()
     if verbose:
-        print('Downloading job output for build %s ...' % (build_num))
-    s_s3 = requests.session()
-    dl = s_s3.get(s3_file_url)
-    output = json.loads(dl.content.decode())
-    message = output[0]['message'] if len(output) > 0 and 'message' in output[0] else ''
-    if not message:
-        raise GetBuildSecretsException('Job output download was empty')
-    message = message.replace('\\n', "\n").replace('\\r', "")
-    message_split = message.split('\n')
+        print('Downloading job output for build %s ...' % (build_num), file=progress)
+    if found_prepare_env_var_action:
+        header = 'Using environment variables from project settings and/or contexts:'
+    else:
+        header = 'Using environment variables from project settings and/or contexts'
 
-    # we only care about env vars listed under "Using environment variables from project settings and/or contexts" that are not "CIRCLE_JOB"
-    try:
-        if found_prepare_env_var_action:
-            index = message_split.index('Using environment variables from project settings and/or contexts:')
-        else:
-            index = message_split.index('Using environment variables from project settings and/or contexts')
-    except Exception as e:
-        index = None
+    # we only care about env vars listed under the header that are not "CIRCLE_JOB", so the download stops once that list ends
+    found_message = False
+    found_header = False
+    secrets = []
+    with s_s3.get(s3_file_url, stream=True) as dl:
+        # output_urls are signed and expire, so a 403 for one from cached build details is retried with fresh details
+        if dl.status_code == 403 and getattr(r, 'from_cache', False) and not fresh:
+            if verbose:
+                print('Job output URL for build %s from the cache was refused, checking the build again ...' % (build_num), file=progress)
+            return get_build_secret_names(project, repo, build_num, forked_builds_user_map, cancelled, True)
+        if dl.status_code != 200:
+            raise GetBuildSecretsException('%s/%s: Job output download failed with code: %s' % (project, repo, dl.status_code))
+        for line in output_message_lines(dl.iter_content(OUTPUT_CHUNK_SIZE)):
+            found_message = found_message or len(line) > 0
+            if cancelled(build_num):
+                raise BuildCancelledException()
+            if not found_header:
+                found_header = line.rstrip('\r') == header
+                continue
+            matches = re.match(r'([^ =]+)=\*\*REDACTED\*\*', line.strip())
+            if matches:
+                secret = matches.group(1)
+                if verbose and secret:
+                    print('Found reference to env var "%s"' % secret, file=progress)
+                if secret and secret != 'CIRCLE_JOB':
+                    secrets.append(secret)
+            elif line.strip():
+                break
+
+    if not found_message:
+        raise GetBuildSecretsException('Job output download was empty')
 
-    if not index:
+    if not found_header:
         raise GetBuildSecretsException(
             '%s/%s: Could not find the "Using environment variables from project settings and/or contexts:" message in the job output' % (project, repo)
         )
 
-    envvars = message_split[index:]
-    secrets = []
-    for envvar in envvars:
-        matches = re.match(r'([^ =]+)=\*\*REDACTED\*\*', envvar.strip())
-        if matches:
-            secret = matches.group(1)
-            if verbose and secret:
-                print('Found reference to env var "%s"' % secret)
-            if secret and secret != 'CIRCLE_JOB':
-                secrets.append(secret)
     return secrets
 
-# go through the forked builds looking for usage of potentially sensitive secrets
-first_try = False
-secrets = []
-for build_num in forked_builds:
+
+def check_project(project, repo):
+    """Checks a project, returning a verdict of whether it may be vulnerable, the secrets found, and the reason for the verdict."""
+    verdict = {'project': '%s/%s' % (project, repo), 'vulnerable': False, 'first_try': False, 'secrets': [], 'reason': ''}
+    pipeline = ProjectPipeline(project, repo)
+    found_prs = False
     try:
-        secrets += get_build_secret_names(build_num)
-    except GetBuildSecretsException as e:
-        if verbose:
-            print(e)
-    if len(secrets) > 0:
-        if forked_builds.index(build_num) == 0:
-            first_try = True
-        if not check_all_circleci_builds:
-            break
+        for pr in forked_prs(project, repo):
+            pipeline.found_pr(pr)
+            found_prs = True
+    except ProjectCheckException as e:
+        verdict['reason'] = str(e)
+        return verdict
+    finally:
+        pipeline.wait()
+
+    if not found_prs:
+        verdict['reason'] = 'No builds found which came from a forked PR - unable to determine whether this project is vulnerable'
+        return verdict
+    if len(pipeline.forked_builds) == 0:
+        verdict['reason'] = 'No CircleCI statuses found - unlikely to be vulnerable'
+        return verdict
+
+    # the newest build having secrets means they were passed on the first try
+    forked_builds = sorted(pipeline.forked_builds, reverse=True)
+    secrets = []
+    for build_num in forked_builds:
+        if build_num in pipeline.build_secrets and (check_all_circleci_builds or build_num == pipeline.newest_with_secrets):
+            secrets += pipeline.build_secrets[build_num]
+    first_try = len(pipeline.build_secrets.get(forked_builds[0], [])) > 0
+
+    if len(secrets) == 0:
+        verdict['reason'] = 'Forked PRs do run builds, but no references to non-default secrets were found'
+        return verdict
+
+    verdict['vulnerable'] = True
+    verdict['first_try'] = first_try
+    verdict['secrets'] = secrets
+    if first_try:
+        verdict['reason'] = 'may be vulnerable!'
+    else:
+        verdict['reason'] = 'an older forked PR build task was passed secrets, may be vulnerable!'
+    return verdict
 
-if len(secrets) == 0:
-    print('%s/%s: Forked PRs do run builds, but no references to non-default secrets were found' % (project, repo))
+
+def check_project_line(line):
+    project = line.strip()
+    if '/' not in project:
+        return {'project': project, 'vulnerable': False, 'first_try': False, 'secrets': [], 'reason': 'Project must be in the format org/repo'}
+    if verbose:
+        print('Trying %s...' % (project), file=progress)
+    try:
+        with metrics.timed('project_seconds'):
+            return check_project(*project.split('/')[:2])
+    except requests.exceptions.RequestException as e:
+        return {'project': project, 'vulnerable': False, 'first_try': False, 'secrets': [], 'reason': 'Request failed: %s' % (e)}
+    except Exception as e:
+        # one project's unexpected API data shouldn't lose the verdicts of the rest
+        return {'project': project, 'vulnerable': False, 'first_try': False, 'secrets': [], 'reason': 'Check failed: %s: %s' % (type(e).__name__, e)}
+
+
+if args.projects_file:
+    projects_file = sys.stdin if args.projects_file == '-' else open(args.projects_file)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(check_project_line, line) for line in projects_file if line.strip() and not line.startswith('#')]
+        for future in as_completed(futures):
+            print(json.dumps(future.result()), flush=True)
+    exit(0)
+
+if '/' not in args.project:
+    print('Project must be in the format org/repo')
     exit(1)
 
-if first_try:
-    print('%s/%s: may be vulnerable!' % (project, repo))
-else:
-    print('%s/%s: an older forked PR build task was passed secrets, may be vulnerable!' % (project, repo))
+project = args.project.split('/')[0]
+repo = args.project.split('/')[1]
+
+print('Trying %s/%s...' % (project, repo))
+
+verdict = check_project(project, repo)
+print('%s/%s: %s' % (project, repo, verdict['reason']))
+if not verdict['vulnerable']:
+    exit(1)
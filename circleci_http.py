@@ -0,0 +1,404 @@
+"""HTTP sessions shared by the circleci-* scripts, backed by an on-disk response cache and a rate limiting scheduler."""
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from circleci_metrics import metrics
+
+
+CIRCLECI_API_URL = 'https://circleci.com/api/v1.1'
+GITHUB_API_URL = 'https://api.github.com'
+
+# the base URLs in use, set from --circleci-url and --github-url by session()
+api_urls = {'circleci': CIRCLECI_API_URL, 'github': GITHUB_API_URL}
+
+DEFAULT_CACHE = 'out/cache/http.sqlite'
+DEFAULT_CACHE_SIZE = 1024
+
+DEFAULT_RATE = 10
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_BUDGET = 100
+
+# statuses worth retrying, Github also uses 403 for rate limits, which is handled separately
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+
+FOREVER = None
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# query params that carry credentials or request signatures, these never end up in a cache key
+SECRET_PARAMS = re.compile(r'^(circle-token|access_token|x-amz-.*|signature|expires|awsaccesskeyid|key-pair-id|policy)$', re.IGNORECASE)
+
+# headers that describe the stored body rather than the response, the body is stored decoded
+STRIP_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'connection')
+
+
+def endpoint(url):
+    """Returns the class of API endpoint a URL is for, used for cache lifetimes and metrics."""
+    if url.startswith(api_urls['circleci']):
+        path = urlparse(url[len(api_urls['circleci']):]).path
+        if re.match(r'^/project/[^/]+/[^/]+/[^/]+/\d+$', path):
+            return 'circleci_build'
+        if re.match(r'^/project/[^/]+/[^/]+/[^/]+$', path):
+            return 'circleci_project'
+        return 'circleci'
+    if url.startswith(api_urls['github']):
+        path = urlparse(url[len(api_urls['github']):]).path
+        if re.match(r'^/repos/[^/]+/[^/]+/commits/[^/]+/status$', path):
+            return 'github_status'
+        if re.match(r'^/repos/[^/]+/[^/]+/pulls$', path):
+            return 'github_pulls'
+        if re.match(r'^/(orgs/[^/]+/(repos|members)|users/[^/]+/repos)$', path):
+            return 'github_list'
+        return 'github'
+    # everything else is a log body behind a build's output_url
+    return 'log'
+
+
+def ttl(url, res):
+    """Returns how long a response can be served from the cache, FOREVER, or 0 to only serve it after revalidation."""
+    kind = endpoint(url)
+    # a finished build never changes, its signed output_urls do expire, so callers refetch it when one is refused
+    if kind == 'circleci_build':
+        build = res.json()
+        return FOREVER if isinstance(build, dict) and build.get('lifecycle') in ('finished', 'not_run') else 0
+    if kind == 'github_status':
+        return DAY if res.json().get('state') != 'pending' else 0
+    if kind in ('circleci_project', 'github_pulls', 'github_list'):
+        return HOUR
+    return 0
+
+
+def cache_key(request):
+    """Returns the URL a request is cached under, and a fingerprint of the credentials it was made with.
+
+    Different credentials can see different data, so they are part of the key, but only as a hash.
+    """
+    parsed = urlparse(request.url)
+    params = parse_qsl(parsed.query, keep_blank_values=True)
+    secrets = [v for k, v in params if SECRET_PARAMS.match(k)]
+    if request.headers.get('Authorization'):
+        secrets.append(request.headers['Authorization'])
+    url = parsed._replace(query=urlencode(sorted((k, v) for k, v in params if not SECRET_PARAMS.match(k)))).geturl()
+    credential = hashlib.sha256('\n'.join(secrets).encode()).hexdigest()[:16] if secrets else 'anonymous'
+    return url, credential
+
+
+class ResponseCache:
+    """SQLite store of GET responses with per-entry expiry and least recently used eviction past max_size bytes."""
+
+    def __init__(self, path, max_size):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT NOT NULL, credential TEXT NOT NULL, status INTEGER NOT NULL, headers TEXT NOT NULL, body BLOB NOT NULL,
+                size INTEGER NOT NULL, etag TEXT, last_modified TEXT, expires REAL, accessed REAL NOT NULL,
+                PRIMARY KEY (url, credential)
+            );
+            CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+        """)
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, url, credential):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT status, headers, body, etag, last_modified, expires FROM responses WHERE url = ? AND credential = ?', (url, credential)
+            ).fetchone()
+            if row:
+                with self.db:
+                    self.db.execute('UPDATE responses SET accessed = ? WHERE url = ? AND credential = ?', (time.time(), url, credential))
+        return row
+
+    def put(self, url, credential, res, ttl):
+        body = res.content
+        # one response may not take over the cache
+        if len(body) > self.max_size / 10:
+            return
+        headers = dict((k, v) for k, v in res.headers.items() if k.lower() not in STRIP_HEADERS)
+        expires = None if ttl is FOREVER else time.time() + ttl
+        with self.lock, self.db:
+            old = self.db.execute('SELECT size FROM responses WHERE url = ? AND credential = ?', (url, credential)).fetchone()
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses (url, credential, status, headers, body, size, etag, last_modified, expires, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, credential, res.status_code, json.dumps(headers), body, len(body), res.headers.get('ETag'), res.headers.get('Last-Modified'), expires, time.time())
+            )
+            self.size += len(body) - (old[0] if old else 0)
+            self.evict()
+
+    def refresh(self, url, credential, ttl):
+        expires = None if ttl is FOREVER else time.time() + ttl
+        with self.lock, self.db:
+            self.db.execute('UPDATE responses SET expires = ?, accessed = ? WHERE url = ? AND credential = ?', (expires, time.time(), url, credential))
+
+    def evict(self):
+        while self.size > self.max_size:
+            rows = self.db.execute('SELECT url, credential, size FROM responses ORDER BY accessed LIMIT 100').fetchall()
+            if not rows:
+                break
+            for url, credential, size in rows:
+                self.db.execute('DELETE FROM responses WHERE url = ? AND credential = ?', (url, credential))
+                self.size -= size
+                if self.size <= self.max_size:
+                    break
+
+
+class TokenBucket:
+    """Allows rate requests per second with bursts of up to burst, and can be paused until a rate limit resets."""
+
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # tokens can go negative, each caller then waits its turn rather than all waking up at once
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate if self.tokens < 0 else 0, self.paused_until - now)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def adapt(self, rate):
+        with self.lock:
+            self.rate = max(rate, 0.01)
+
+
+class Scheduler:
+    """Sends every request through a token bucket per host and credential, retrying failures with jittered exponential backoff.
+
+    Once Github's X-RateLimit-Remaining runs low the bucket slows down to spread the remaining requests until
+    X-RateLimit-Reset, and running out or a Retry-After pauses it. Retries come out of a budget shared by the whole run, so a failing
+    API surfaces errors rather than being retried forever.
+    """
+
+    def __init__(self, rates, max_retries, retry_budget):
+        self.lock = threading.Lock()
+        self.rates = rates
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.buckets = {}
+
+    def bucket(self, host, credential):
+        with self.lock:
+            if (host, credential) not in self.buckets:
+                rate = self.rates.get(host)
+                self.buckets[(host, credential)] = TokenBucket(rate, rate * 2) if rate else None
+            return self.buckets[(host, credential)]
+
+    def retry(self, attempt):
+        with self.lock:
+            if attempt >= self.max_retries or self.retry_budget <= 0:
+                return False
+            self.retry_budget -= 1
+            return True
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+    def observe(self, bucket, host, res):
+        """Adapts the bucket to the response's rate limit headers, returning how long to wait before a retry, if it needs one."""
+        limit = res.headers.get('X-RateLimit-Limit')
+        remaining = res.headers.get('X-RateLimit-Remaining')
+        reset = res.headers.get('X-RateLimit-Reset')
+        retry_after = res.headers.get('Retry-After')
+        wait = None
+        if bucket and remaining is not None and reset is not None:
+            until_reset = max(float(reset) - time.time(), 1)
+            if int(remaining) == 0:
+                bucket.pause(until_reset)
+                wait = until_reset
+            elif limit and int(remaining) < int(limit) / 10:
+                # running low, so spread what is left over the time until the reset
+                bucket.adapt(min(self.rates[host], int(remaining) / until_reset))
+            else:
+                bucket.adapt(self.rates[host])
+        if retry_after is not None and res.status_code in (403, 429, 503):
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                wait = BACKOFF_CAP
+            if bucket:
+                bucket.pause(wait)
+        if res.status_code in RETRY_STATUSES or (res.status_code == 403 and wait is not None):
+            return wait if wait is not None else 0
+        return None
+
+    def send(self, send, request):
+        host = urlparse(request.url).netloc
+        kind = endpoint(request.url)
+        bucket = self.bucket(host, cache_key(request)[1])
+        attempt = 0
+        while True:
+            if bucket:
+                start = time.perf_counter()
+                bucket.acquire()
+                metrics.add('rate_limit_wait_seconds', time.perf_counter() - start, endpoint=kind)
+            try:
+                res = send()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                metrics.add('http_errors', endpoint=kind, error=type(e).__name__)
+                if not self.retry(attempt):
+                    raise
+                metrics.add('http_retries', endpoint=kind)
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            wait = self.observe(bucket, host, res)
+            if wait is None or not self.retry(attempt):
+                return res
+            metrics.add('http_retries', endpoint=kind)
+            print('Got %s from %s, retrying...' % (res.status_code, host), file=sys.stderr)
+            res.close()
+            # a paused bucket already waits out the rate limit, otherwise back off
+            if not bucket or wait == 0:
+                time.sleep(max(wait, self.backoff(attempt)))
+            attempt += 1
+
+
+def cached_response(request, status, headers, body):
+    res = requests.Response()
+    res.status_code = status
+    res.headers = CaseInsensitiveDict(json.loads(headers))
+    res._content = body
+    # marking the content consumed lets iter_content() serve the stored body to streaming callers
+    res._content_consumed = True
+    res.url = request.url
+    res.request = request
+    res.reason = 'OK'
+    res.encoding = requests.utils.get_encoding_from_headers(res.headers)
+    res.from_cache = True
+    return res
+
+
+class Session(requests.Session):
+    """A requests session which serves GET responses from a ResponseCache, revalidating stale entries with ETags,
+    and sends everything else through a Scheduler."""
+
+    def __init__(self, cache, scheduler, pool_size=10):
+        super().__init__()
+        self.cache = cache
+        self.scheduler = scheduler
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def send(self, request, **kwargs):
+        if self.cache is None or request.method != 'GET':
+            return self.scheduled_send(request, **kwargs)
+        url, credential = cache_key(request)
+        kind = endpoint(url)
+        # callers that need fresh data send Cache-Control: no-cache, the response is still stored
+        entry = None if request.headers.get('Cache-Control') == 'no-cache' else self.cache.get(url, credential)
+        if entry:
+            status, headers, body, etag, last_modified, expires = entry
+            if expires is None or expires > time.time():
+                metrics.add('cache_hits', endpoint=kind)
+                return cached_response(request, status, headers, body)
+            if etag:
+                request.headers['If-None-Match'] = etag
+            if last_modified:
+                request.headers['If-Modified-Since'] = last_modified
+        res = self.scheduled_send(request, **kwargs)
+        res.from_cache = False
+        if res.status_code == 304 and entry:
+            metrics.add('cache_revalidated', endpoint=kind)
+            res.close()
+            cached = cached_response(request, status, headers, body)
+            self.cache.refresh(url, credential, ttl(url, cached))
+            return cached
+        metrics.add('cache_misses', endpoint=kind)
+        # streamed bodies are left to the caller, only responses read in full are stored
+        if res.status_code == 200 and not kwargs.get('stream'):
+            lifetime = ttl(url, res)
+            if lifetime is FOREVER or lifetime > 0 or res.headers.get('ETag') or res.headers.get('Last-Modified'):
+                self.cache.put(url, credential, res, lifetime)
+        return res
+
+    def scheduled_send(self, request, **kwargs):
+        if self.scheduler is None:
+            return self.timed_send(request, **kwargs)
+        return self.scheduler.send(lambda: self.timed_send(request, **kwargs), request)
+
+    def timed_send(self, request, **kwargs):
+        """Sends a request, recording its latency and size, streamed responses are timed until their headers arrive."""
+        kind = endpoint(request.url)
+        start = time.perf_counter()
+        res = super().send(request, **kwargs)
+        metrics.observe('http_request_seconds', time.perf_counter() - start, endpoint=kind)
+        metrics.add('http_responses', endpoint=kind, status=res.status_code)
+        if not kwargs.get('stream'):
+            metrics.add('http_bytes_in', len(res.content), endpoint=kind)
+            return res
+        # streamed bodies are counted as the caller reads them
+        iter_content = res.iter_content
+
+        def counted_content(chunk_size=1, decode_unicode=False):
+            for chunk in iter_content(chunk_size, decode_unicode):
+                metrics.add('http_bytes_in', len(chunk), endpoint=kind)
+                yield chunk
+        res.iter_content = counted_content
+        return res
+
+
+_caches = {}
+_schedulers = []
+
+
+def base_url(value):
+    return value.rstrip('/')
+
+
+def add_arguments(parser):
+    parser.add_argument("--circleci-url", type=base_url, default=os.environ.get('CIRCLECI_API_URL', CIRCLECI_API_URL), help="Base URL of the CircleCI API, also read from $CIRCLECI_API_URL, e.g. to run against a mock server")
+    parser.add_argument("--github-url", type=base_url, default=os.environ.get('GITHUB_API_URL', GITHUB_API_URL), help="Base URL of the Github API, also read from $GITHUB_API_URL")
+    parser.add_argument("--cache", default=DEFAULT_CACHE, help="SQLite file to cache HTTP responses in, shared by the circleci-* scripts, empty to disable")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, help="Maximum size of the HTTP response cache in MB")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="Maximum requests per second to each of the Github and CircleCI APIs, per token")
+    parser.add_argument("--max-retries", type=int, default=DEFAULT_MAX_RETRIES, help="Maximum times to retry a failed or rate limited request")
+    parser.add_argument("--retry-budget", type=int, default=DEFAULT_RETRY_BUDGET, help="Maximum retries across the whole run")
+
+
+def session(args, pool_size=10):
+    """Returns a session using the cache and scheduler configured by add_arguments().
+
+    One cache is shared per file and one scheduler per process, so every session counts against the same rate limits.
+    """
+    cache = None
+    if args.cache:
+        if args.cache not in _caches:
+            _caches[args.cache] = ResponseCache(args.cache, args.cache_size * 1024 * 1024)
+        cache = _caches[args.cache]
+    api_urls['circleci'] = args.circleci_url
+    api_urls['github'] = args.github_url
+    if not _schedulers:
+        rates = {urlparse(args.circleci_url).netloc: args.rate, urlparse(args.github_url).netloc: args.rate}
+        _schedulers.append(Scheduler(rates, args.max_retries, args.retry_budget))
+    return Session(cache, _schedulers[0], pool_size)
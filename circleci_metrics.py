@@ -0,0 +1,166 @@
+"""Metrics and profiling shared by the circleci-* scripts.
+
+Latencies go into histograms and everything else into counters, each keyed by a name and labels, e.g. the
+endpoint class of a request. They are written at exit to the files given with --metrics, as JSON or as a
+Prometheus textfile, and --profile dumps cProfile stats of every thread.
+"""
+import atexit
+import bisect
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+# latency buckets in seconds, from a cached response to a slow log download
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Metrics:
+    """Thread safe counters and histograms, each series keyed by name and labels."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def to_json(self, script):
+        with self.lock:
+            return {
+                'script': script,
+                'started': self.started,
+                'wall_seconds': round(time.time() - self.started, 3),
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())
+                ],
+                'histograms': [
+                    {
+                        'name': name, 'labels': dict(labels), 'count': h.count, 'sum': round(h.sum, 6),
+                        'mean': round(h.sum / h.count, 6) if h.count else 0, 'max': round(h.max, 6),
+                        'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], h.counts))
+                    } for (name, labels), h in sorted(self.histograms.items())
+                ],
+            }
+
+    def to_prometheus(self, script):
+        def series(name, labels, extra=()):
+            pairs = [('script', script)] + list(labels) + list(extra)
+            return 'circleci_%s{%s}' % (name, ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs))
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE circleci_%s_total counter' % (name))
+                    typed.add(name)
+                lines.append('%s %s' % (series(name + '_total', labels), value))
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE circleci_%s histogram' % (name))
+                    typed.add(name)
+                cumulative = 0
+                for le, count in zip([str(b) for b in BUCKETS] + ['+Inf'], h.counts):
+                    cumulative += count
+                    lines.append('%s %s' % (series(name + '_bucket', labels, [('le', le)]), cumulative))
+                lines.append('%s %s' % (series(name + '_sum', labels), h.sum))
+                lines.append('%s %s' % (series(name + '_count', labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class ThreadProfiler:
+    """cProfile only profiles the thread it is enabled in, so this enables a profile in every thread started after it.
+
+    From Python 3.12 a single profile already sees every thread, and only one can be enabled at a time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = []
+        if sys.version_info < (3, 12):
+            threading.setprofile(self.start_thread)
+        self.start_thread()
+
+    def start_thread(self, *unused):
+        # called once on a new thread's first profiling event, enabling the profile replaces this hook for the thread
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def dump(self, path):
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        with self.lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.disable()
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(path)
+
+
+def add_arguments(parser):
+    parser.add_argument("--metrics", action="append", help="File to write request and I/O metrics to at exit, a Prometheus textfile if it ends in .prom, otherwise JSON. Can be given more than once")
+    parser.add_argument("--profile", help="File to write cProfile stats of every thread to at exit, for use with pstats or snakeviz")
+
+
+def write(paths, profiler, profile_path):
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    for path in paths or []:
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(metrics.to_prometheus(script))
+            else:
+                json.dump(metrics.to_json(script), f, indent=2)
+    if profiler:
+        profiler.dump(profile_path)
+
+
+def start(args):
+    """Starts profiling if --profile was given, and writes the metrics and profile when the script exits."""
+    profiler = ThreadProfiler() if args.profile else None
+    if args.metrics or profiler:
+        atexit.register(write, args.metrics, profiler, args.profile)
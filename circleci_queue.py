@@ -0,0 +1,144 @@
+"""Work queue shared by circleci-crawl.py workers, in a SQLite database they can all open.
+
+Every project is first a list item, whose worker lists the builds the project still needs and queues a build item
+for each. Workers lease a batch of items for a while, heartbeat to keep the lease while they work, and mark each item
+done or failed. Items whose lease runs out, because their worker died or lost touch, go back to pending for another
+worker, and items that have failed max_attempts times are left as failed until retried.
+"""
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+
+LIST = 'list'
+BUILD = 'build'
+
+
+class Lease:
+    """Items leased together, always of one kind and one project. builds is empty for a list lease."""
+
+    def __init__(self, id, kind, project, builds):
+        self.id = id
+        self.kind = kind
+        self.project = project
+        self.builds = builds
+
+
+class Queue:
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # transactions are begun explicitly so leasing can take the write lock before reading
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                id INTEGER PRIMARY KEY, kind TEXT NOT NULL, project TEXT NOT NULL, build_num INTEGER NOT NULL,
+                state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, lease TEXT, worker TEXT, expires REAL,
+                error TEXT, updated_at REAL NOT NULL, UNIQUE (kind, project, build_num)
+            );
+            CREATE INDEX IF NOT EXISTS items_state ON items (state, kind, project, build_num);
+            CREATE INDEX IF NOT EXISTS items_lease ON items (lease);
+        """)
+
+    def close(self):
+        self.db.close()
+
+    @contextmanager
+    def transaction(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def add(self, kind, project, build_nums):
+        # items already queued are left alone, finished ones are queued again
+        self.db.executemany("""
+            INSERT INTO items (kind, project, build_num, state, updated_at) VALUES (?, ?, ?, 'pending', ?)
+            ON CONFLICT (kind, project, build_num) DO UPDATE SET state = 'pending', attempts = 0, error = NULL, updated_at = excluded.updated_at
+            WHERE state IN ('done', 'failed')
+        """, [(kind, project, build_num, time.time()) for build_num in build_nums])
+
+    def add_projects(self, projects):
+        with self.transaction():
+            for project in projects:
+                self.add(LIST, project, [0])
+
+    def expire(self):
+        """Returns items whose lease ran out to pending, or failed once they have used up their attempts."""
+        self.db.execute("""
+            UPDATE items SET state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END, attempts = attempts + 1,
+                error = 'lease held by ' || worker || ' expired', lease = NULL, updated_at = ?
+            WHERE state = 'leased' AND expires < ?
+        """, (self.max_attempts, time.time(), time.time()))
+
+    def lease(self, worker, batch=1):
+        """Leases up to batch pending items of one project, list items first so builds are found early, or returns None."""
+        with self.transaction():
+            self.expire()
+            row = self.db.execute("SELECT kind, project FROM items WHERE state = 'pending' ORDER BY kind = ? DESC, id LIMIT 1", (LIST,)).fetchone()
+            if row is None:
+                return None
+            kind, project = row
+            rows = self.db.execute(
+                "SELECT id, build_num FROM items WHERE state = 'pending' AND kind = ? AND project = ? ORDER BY build_num LIMIT ?",
+                (kind, project, 1 if kind == LIST else batch)
+            ).fetchall()
+            lease = Lease(uuid.uuid4().hex, kind, project, [build_num for id, build_num in rows] if kind == BUILD else [])
+            self.db.executemany(
+                "UPDATE items SET state = 'leased', lease = ?, worker = ?, expires = ?, updated_at = ? WHERE id = ?",
+                [(lease.id, worker, time.time() + self.lease_seconds, time.time(), id) for id, build_num in rows]
+            )
+        return lease
+
+    def heartbeat(self, lease):
+        """Extends a lease, returning False if it already ran out and its items may have gone to another worker."""
+        cursor = self.db.execute(
+            "UPDATE items SET expires = ?, updated_at = ? WHERE lease = ? AND state = 'leased'",
+            (time.time() + self.lease_seconds, time.time(), lease.id)
+        )
+        return cursor.rowcount > 0
+
+    def finish(self, lease, failed=(), error=None, listed=()):
+        """Marks the lease's items done, except the build_nums in failed which are retried, and queues the listed builds."""
+        with self.transaction():
+            if listed:
+                self.add(BUILD, lease.project, listed)
+            for build_num in failed:
+                self.db.execute("""
+                    UPDATE items SET state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END, attempts = attempts + 1,
+                        lease = NULL, error = ?, updated_at = ?
+                    WHERE lease = ? AND state = 'leased' AND build_num = ?
+                """, (self.max_attempts, error, time.time(), lease.id, build_num))
+            self.db.execute(
+                "UPDATE items SET state = 'done', lease = NULL, error = NULL, updated_at = ? WHERE lease = ? AND state = 'leased'",
+                (time.time(), lease.id)
+            )
+
+    def retry_failed(self):
+        with self.transaction():
+            return self.db.execute("UPDATE items SET state = 'pending', attempts = 0, updated_at = ? WHERE state = 'failed'", (time.time(),)).rowcount
+
+    def outstanding(self):
+        """Number of items still pending or leased, once expired leases are returned."""
+        with self.transaction():
+            self.expire()
+            return self.db.execute("SELECT COUNT(*) FROM items WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+    def counts(self):
+        """Returns the number of items in each state, by kind."""
+        counts = {}
+        for kind, state, count in self.db.execute('SELECT kind, state, COUNT(*) FROM items GROUP BY kind, state'):
+            counts.setdefault(kind, {})[state] = count
+        return counts
+
+    def failures(self):
+        return self.db.execute(
+            "SELECT kind, project, build_num, attempts, error FROM items WHERE state = 'failed' ORDER BY project, kind, build_num"
+        ).fetchall()
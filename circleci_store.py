@@ -0,0 +1,340 @@
+"""Storage of the logs downloaded by circleci-logs.py, and reading them back for the other circleci-* scripts.
+
+Logs are stored either as one file per action, out/circleci/ORG/REPO/BUILD/job-X-Y (or job-X-Y.gz), or packed into
+out/circleci/ORG/REPO/packs/FIRST-LAST.pack archives holding the logs of a range of builds. A pack is the logs
+appended one after another, each gzip compressed on its own when compression is on, so the pack is also a valid
+multi-member gzip file. The FIRST-LAST.idx file next to it has a JSON line per log giving its build, job, offset and
+length, so a single log can be read without touching the rest.
+
+Logs can also be stored by content, once for every project, as out/circleci/.objects/AB/ABCDEF... named by the
+sha256 of the log. Which log is which blob is then only recorded in the project's manifest.sqlite.
+"""
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from circleci_metrics import metrics
+
+
+PACK_NAME = re.compile(r'^(\d+)-(\d+)\.pack$')
+OBJECTS_DIR = '.objects'
+# logs up to this size are hashed in memory before deciding whether they need writing
+SPOOL_SIZE = 4 * 1024 * 1024
+
+
+class FileStore:
+    """Writes each log to its own file under its build's directory."""
+
+    def __init__(self, project_dir, compress=False):
+        self.project_dir = project_dir
+        self.compress = compress
+
+    def write(self, build_num, job, chunks):
+        """Writes a log from an iterable of byte chunks, returning its path relative to the project, size and sha256."""
+        path = '{}/{}'.format(build_num, job)
+        if self.compress:
+            path += '.gz'
+        filename = os.path.join(self.project_dir, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # write to a temporary name first so an interrupted download never looks complete, named by process as crawl workers can overlap
+        part = '{}.{}.part'.format(filename, os.getpid())
+        with open(part, 'wb') as f:
+            size, digest = write_chunks(f, chunks, self.compress)
+        os.replace(part, filename)
+        return path, size, digest
+
+
+class PackStore:
+    """Appends logs to a pack per builds_per_pack builds, with an index of where each log is."""
+
+    def __init__(self, project_dir, compress=False, builds_per_pack=1):
+        self.project_dir = project_dir
+        self.compress = compress
+        self.builds_per_pack = builds_per_pack
+        self.lock = threading.Lock()
+        self.pack_locks = {}
+
+    def pack_name(self, build_num):
+        first = (build_num - 1) // self.builds_per_pack * self.builds_per_pack + 1
+        return 'packs/{}-{}'.format(first, first + self.builds_per_pack - 1)
+
+    def write(self, build_num, job, chunks):
+        name = self.pack_name(build_num)
+        pack = os.path.join(self.project_dir, name)
+        os.makedirs(os.path.dirname(pack), exist_ok=True)
+        # logs are downloaded to a temporary file, then appended under a lock, so concurrent downloads into one pack don't block each other
+        part = '{}.{}.{}.{}.part'.format(pack, build_num, job, os.getpid())
+        with open(part, 'wb') as f:
+            size, digest = write_chunks(f, chunks, self.compress)
+        with self.lock:
+            pack_lock = self.pack_locks.setdefault(name, threading.Lock())
+        with pack_lock:
+            with open(pack + '.pack', 'ab') as out, open(part, 'rb') as member:
+                # other processes, like crawl workers, can append to the same pack, so it is also locked on disk
+                fcntl.lockf(out, fcntl.LOCK_EX)
+                offset = out.seek(0, os.SEEK_END)
+                shutil.copyfileobj(member, out)
+                out.flush()
+                length = out.tell() - offset
+                # the index entry is only written once the log is in the pack, a log without one is ignored by readers
+                entry = {'build': build_num, 'job': job, 'offset': offset, 'length': length, 'size': size, 'compressed': self.compress}
+                with open(pack + '.idx', 'a') as index:
+                    index.write(json.dumps(entry) + '\n')
+        os.remove(part)
+        return name + '.pack', size, digest
+
+
+class ObjectStore:
+    """Stores each distinct log once under root/.objects by its sha256, shared by every project under root."""
+
+    def __init__(self, root, project_dir, compress=False):
+        self.objects_dir = os.path.join(root, OBJECTS_DIR)
+        self.project_dir = project_dir
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.stored = 0
+        self.deduplicated = 0
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def write(self, build_num, job, chunks):
+        # the log has to be hashed before its name is known, most fit in memory so one already stored costs no disk write
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE, dir=self.objects_dir) as spool:
+            size, digest = write_chunks(spool, chunks, self.compress)
+            blob = os.path.join(self.objects_dir, digest[:2], digest)
+            existing = [name for name in (blob, blob + '.gz') if os.path.exists(name)]
+            if existing:
+                blob = existing[0]
+                with self.lock:
+                    self.deduplicated += 1
+            else:
+                if self.compress:
+                    blob += '.gz'
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                # two downloads of the same log can race here, which is harmless as they write the same content
+                part = '{}.{}.{}.part'.format(blob, os.getpid(), threading.get_ident())
+                spool.seek(0)
+                with open(part, 'wb') as out:
+                    shutil.copyfileobj(spool, out)
+                os.replace(part, blob)
+                with self.lock:
+                    self.stored += 1
+        # paths are relative to the project directory like those of the other stores
+        return os.path.relpath(blob, self.project_dir), size, digest
+
+
+def write_chunks(f, chunks, compress):
+    size = 0
+    digest = hashlib.sha256()
+    # only the time spent hashing, compressing and writing is counted, not waiting on chunks from the network
+    busy = 0
+    out = gzip.GzipFile(fileobj=f, mode='wb') if compress else f
+    for chunk in chunks:
+        start = time.perf_counter()
+        out.write(chunk)
+        size += len(chunk)
+        digest.update(chunk)
+        busy += time.perf_counter() - start
+    if compress:
+        start = time.perf_counter()
+        out.close()
+        busy += time.perf_counter() - start
+    metrics.add('write_seconds', busy, compressed=compress)
+    metrics.add('bytes_written', size, compressed=compress)
+    return size, digest.hexdigest()
+
+
+class Slice(io.RawIOBase):
+    """Read only view of length bytes of a file from offset."""
+
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.f.seek(offset)
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.f.read(min(len(b), self.remaining))
+        b[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+class Log:
+    """A downloaded job log, wherever it is stored.
+
+    path is the file holding it, and offset and length where it is in that file. compressed logs have to be read
+    through open(), the others can also be mmap'd straight from path. digest is the sha256 of the log when the
+    manifest has it, logs with the same digest are identical.
+    """
+
+    def __init__(self, org, repo, build, job, path, offset=0, length=None, compressed=False, digest=None, immutable=False):
+        self.org = org
+        self.repo = repo
+        self.build = build
+        self.job = job
+        self.path = path
+        self.offset = offset
+        self.length = os.path.getsize(path) if length is None else length
+        self.compressed = compressed
+        self.digest = digest
+        self.immutable = immutable
+
+    @property
+    def key(self):
+        return '{}/{}/{}/{}'.format(self.org, self.repo, self.build, self.job)
+
+    @property
+    def stamp(self):
+        """Changes whenever the log does, packed and content addressed logs never change once written."""
+        if self.immutable:
+            return '{}:{}:{}'.format(self.offset, self.length, self.digest)
+        st = os.stat(self.path)
+        return '{}:{}'.format(st.st_size, st.st_mtime)
+
+    def open(self):
+        f = Slice(open(self.path, 'rb'), self.offset, self.length)
+        return gzip.GzipFile(fileobj=io.BufferedReader(f)) if self.compressed else io.BufferedReader(f)
+
+    def read(self):
+        with self.open() as f:
+            return f.read()
+
+
+def pack_logs(org, repo, pack):
+    """Returns the logs in a pack by (build, job), the last index entry for a log wins as it may have been rewritten."""
+    logs = {}
+    index = pack[:-len('.pack')] + '.idx'
+    if not os.path.exists(index):
+        return logs
+    with open(index) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a line cut short by a crash mid-write
+                continue
+            logs[(entry['build'], entry['job'])] = Log(
+                org, repo, entry['build'], entry['job'], pack, entry['offset'], entry['length'], entry['compressed'], immutable=True
+            )
+    return logs
+
+
+def manifest_actions(project_dir, build=None):
+    """Returns the path relative to project_dir, sha256 and size of each downloaded log in the project's manifest, by (build, job)."""
+    manifest = os.path.join(project_dir, 'manifest.sqlite')
+    if not os.path.exists(manifest):
+        return {}
+    db = sqlite3.connect(manifest)
+    try:
+        sql = 'SELECT build_num, job, action, path, sha256, size FROM actions WHERE path IS NOT NULL'
+        rows = db.execute(sql) if build is None else db.execute(sql + ' AND build_num = ?', (build,))
+        return dict((((b, 'job-{}-{}'.format(j, a)), (path, digest, size)) for b, j, a, path, digest, size in rows))
+    finally:
+        db.close()
+
+
+def object_log(org, repo, project_dir, build, job, path, digest):
+    """Returns a content addressed log from its manifest entry, or None if the entry is for another store."""
+    if OBJECTS_DIR not in path.split('/'):
+        return None
+    blob = os.path.normpath(os.path.join(project_dir, path))
+    if not os.path.exists(blob):
+        return None
+    return Log(org, repo, build, job, blob, compressed=blob.endswith('.gz'), digest=digest, immutable=True)
+
+
+def project_logs(root, org, repo):
+    """Yields every log of a project, whichever way it was stored."""
+    project_dir = os.path.join(root, org, repo)
+    actions = manifest_actions(project_dir)
+    for entry in sorted(os.scandir(project_dir), key=lambda entry: entry.name):
+        if entry.name == 'packs' and entry.is_dir():
+            for pack in sorted(os.scandir(entry.path), key=lambda pack: pack.name):
+                if PACK_NAME.match(pack.name):
+                    for key, log in pack_logs(org, repo, pack.path).items():
+                        log.digest = actions.get(key, (None, None, None))[1]
+                        yield log
+        elif entry.name.isdigit() and entry.is_dir():
+            for log in sorted(os.scandir(entry.path), key=lambda log: log.name):
+                if log.name.startswith('job-') and not log.name.endswith('.part'):
+                    compressed = log.name.endswith('.gz')
+                    job = log.name[:-3] if compressed else log.name
+                    digest = actions.get((int(entry.name), job), (None, None, None))[1]
+                    yield Log(org, repo, int(entry.name), job, log.path, compressed=compressed, digest=digest)
+    for (build, job), (path, digest, size) in sorted(actions.items()):
+        log = object_log(org, repo, project_dir, build, job, path, digest)
+        if log:
+            yield log
+
+
+def projects(root):
+    """Yields the (org, repo) of every project under root."""
+    for org in sorted(os.scandir(root), key=lambda entry: entry.name):
+        # .objects holds the content addressed logs, which are found through each project's manifest
+        if not org.is_dir() or org.name.startswith('.'):
+            continue
+        for repo in sorted(os.scandir(org.path), key=lambda entry: entry.name):
+            if repo.is_dir():
+                yield org.name, repo.name
+
+
+def iter_logs(root, project=None):
+    """Yields every log under root, or only those of project if given as org/repo."""
+    if project:
+        org, repo = project.split('/')[:2]
+        if os.path.isdir(os.path.join(root, org, repo)):
+            yield from project_logs(root, org, repo)
+        return
+    for org, repo in projects(root):
+        yield from project_logs(root, org, repo)
+
+
+def unique_logs(logs):
+    """Returns the logs with only one of each digest, and the logs sharing each digest so results can be copied to them."""
+    copies = {}
+    unique = []
+    for log in logs:
+        if log.digest is None:
+            unique.append(log)
+        elif log.digest in copies:
+            copies[log.digest].append(log)
+        else:
+            copies[log.digest] = [log]
+            unique.append(log)
+    return unique, copies
+
+
+def find_log(root, org, repo, build, job):
+    """Returns a single log, or None if it hasn't been downloaded."""
+    build_dir = os.path.join(root, org, repo, str(build))
+    for compressed, name in ((False, job), (True, job + '.gz')):
+        if os.path.exists(os.path.join(build_dir, name)):
+            return Log(org, repo, build, job, os.path.join(build_dir, name), compressed=compressed)
+    packs = os.path.join(root, org, repo, 'packs')
+    if os.path.isdir(packs):
+        for pack in os.scandir(packs):
+            match = PACK_NAME.match(pack.name)
+            if match and int(match.group(1)) <= build <= int(match.group(2)):
+                log = pack_logs(org, repo, pack.path).get((build, job))
+                if log:
+                    return log
+    project_dir = os.path.join(root, org, repo)
+    action = manifest_actions(project_dir, build).get((build, job))
+    if action:
+        return object_log(org, repo, project_dir, build, job, action[0], action[1])
+    return None
@@ -0,0 +1,19 @@
+import importlib.util
+import os
+import sys
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the scripts import the circleci_* modules from the repo root, however pytest was started
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+
+def load_script(name):
+    # the scripts have hyphenated names, so they can't be imported normally
+    path = os.path.join(REPO_DIR, name)
+    spec = importlib.util.spec_from_file_location(name[:-3].replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,46 @@
+from conftest import load_script
+
+
+index = load_script('circleci-index.py')
+
+
+def test_regex_literals():
+    assert index.regex_literals(r'SECRET_\d{1,2}=') == ['SECRET_']
+    assert index.regex_literals(r'token\d{100}') == ['token']
+    assert index.regex_literals(r'x{10,20}abc') == ['abc']
+    assert index.regex_literals(r'[{]abc{2}def') == ['def']
+
+
+def test_regex_literals_skip_long_escapes():
+    assert index.regex_literals(r'\x41BCDEF') == ['BCDEF']
+    assert index.regex_literals(r'\101BCDE') == ['BCDE']
+    assert index.regex_literals(r'\u0041BCDE') == ['BCDE']
+    assert index.regex_literals(r'\U00000041BCDE') == ['BCDE']
+    assert index.regex_literals(r'\N{LATIN CAPITAL LETTER A}BCDE') == ['BCDE']
+    assert index.regex_literals(r'(abc)\1DEF') == ['DEF']
+    assert index.regex_literals(r'\x53ECRET_3') == ['ECRET_3']
+
+
+def test_regex_literals_verbose_flag():
+    assert index.regex_literals(r'(?x) SECRET _3') == []
+    assert index.regex_literals(r'(?ix)SECRET_3') == []
+
+
+def slow_trigrams(data):
+    data = data.lower()
+    return set(int.from_bytes(data[i:i + 3], 'big') for i in range(len(data) - 2))
+
+
+def test_trigrams_match_every_offset():
+    data = b'Using environment variables from project settings\n  SECRET_0=**REDACTED**\n'
+    for end in range(len(data) + 1):
+        assert index.trigrams(data[:end]) == slow_trigrams(data[:end])
+
+
+def test_index_log_across_chunks(tmp_path, monkeypatch):
+    data = b'abcdefghij' * 7 + b'TOKEN'
+    path = tmp_path / 'job-0-0'
+    path.write_bytes(data)
+    monkeypatch.setattr(index, 'CHUNK_SIZE', 7)
+    log = index.circleci_store.Log('o', 'r', 1, 'job-0-0', str(path))
+    assert index.index_log(log)[1] == slow_trigrams(data)
@@ -0,0 +1,114 @@
+import ast
+import json
+import os
+import random
+
+import pytest
+
+from conftest import REPO_DIR
+
+
+HEADER = 'Using environment variables from project settings and/or contexts:'
+
+
+def load_definitions(name, names):
+    # running the script would parse argv and check a project, so only its imports, constants and the named functions are run
+    path = os.path.join(REPO_DIR, name)
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    body = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            body.append(node)
+        elif isinstance(node, ast.Assign) and all(isinstance(target, ast.Name) and target.id.isupper() for target in node.targets):
+            body.append(node)
+        elif isinstance(node, ast.FunctionDef) and node.name in names:
+            body.append(node)
+    namespace = {}
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, 'exec'), namespace)
+    return namespace
+
+
+config = load_definitions('circleci-vulnerable-config.py', {'output_message_pieces', 'replace_escape', 'output_message_lines', 'join_surrogates'})
+output_message_lines = config['output_message_lines']
+
+
+def old_message_lines(body):
+    # what get_build_secret_names did before the output was streamed
+    message = json.loads(body)[0]['message']
+    return message.replace('\\n', "\n").replace('\\r', "").split('\n')
+
+
+def split_at(body, positions):
+    positions = [0] + sorted(positions) + [len(body)]
+    return [body[start:end] for start, end in zip(positions, positions[1:])]
+
+
+def output(message, ensure_ascii=True):
+    return json.dumps([{'message': message, 'type': 'out'}, {'message': 'second\nstep', 'type': 'out'}], ensure_ascii=ensure_ascii).encode()
+
+
+MESSAGES = [
+    '',
+    'one line',
+    HEADER + '\n  SECRET_1=****\n  SECRET_2=****\n\nnext',
+    'quotes " and \\ and / and \t tabs\r\nwindows\r\nlines',
+    # already escaped newlines in the output are unescaped again, as they were before
+    'literal \\n and \\r in the output\\r\\n',
+    'emoji \U0001F600 and \U0001F510 outside the BMP, é and 中 inside it',
+    'control \x00 \x1f \b \f characters',
+    'trailing backslash \\',
+]
+
+
+@pytest.mark.parametrize('ensure_ascii', [True, False])
+@pytest.mark.parametrize('message', MESSAGES)
+def test_split_at_every_position(message, ensure_ascii):
+    body = output(message, ensure_ascii)
+    expected = old_message_lines(body)
+    assert list(output_message_lines([body])) == expected
+    for i in range(len(body) + 1):
+        assert list(output_message_lines(split_at(body, [i]))) == expected, i
+    assert list(output_message_lines(split_at(body, range(len(body))))) == expected
+
+
+def test_random_messages():
+    rnd = random.Random(1)
+    alphabet = 'ab \n\r\\"/\t\x01é中\U0001F600'
+    for _ in range(500):
+        message = ''.join(rnd.choice(alphabet) for _ in range(rnd.randrange(40)))
+        body = output(message, rnd.random() < 0.5)
+        positions = [rnd.randrange(len(body) + 1) for _ in range(rnd.randrange(6))]
+        assert list(output_message_lines(split_at(body, positions))) == old_message_lines(body), (message, positions)
+
+
+def test_surrogate_pair_split_between_chunks():
+    body = output('a\U0001F600b')
+    assert b'\\ud83d\\ude00' in body
+    start = body.index(b'\\ud83d')
+    # between the two escapes, and in the middle of each of them
+    for i in (start + 3, start + 6, start + 9):
+        assert list(output_message_lines(split_at(body, [i]))) == ['a\U0001F600b']
+
+
+def test_lone_surrogate_is_replaced():
+    # json.loads keeps an unpaired surrogate, the lines get a replacement character instead so they can be printed
+    assert list(output_message_lines([output('a\ud800b')])) == ['a\ufffdb']
+
+
+def test_header_on_first_line():
+    body = output(HEADER + '\n  SECRET_1=****')
+    lines = list(output_message_lines(split_at(body, [20, 40])))
+    assert lines[0] == HEADER
+    assert lines == old_message_lines(body)
+
+
+def test_key_split_between_chunks():
+    body = output('found it')
+    start = body.index(b'"message"')
+    for i in range(start, start + len(b'"message": "') + 1):
+        assert list(output_message_lines(split_at(body, [i]))) == ['found it'], i
+
+
+def test_no_message():
+    assert list(output_message_lines([b'[]'])) == ['']